@@ -0,0 +1,242 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import botocore
+
+import aws_api
+from aws_api import chunked, APIError
+
+
+class AsyncClient:
+    """Asyncio counterpart of 'aws_api.Client'.
+
+    Blocking botocore calls run on a dedicated pool of 'max_workers' threads while retries,
+    rate limiting and spot request polling wait with 'asyncio.sleep', so waiting never holds
+    a thread. Configuration, rate limiter, caches and metrics are shared with the wrapped
+    synchronous 'client' (created from 'config' and 'kwargs' unless given).
+
+    Every coroutine can be cancelled or bounded with 'asyncio.wait_for': the awaiting task
+    stops at once, a botocore call already running completes in its thread and its result is
+    dropped. Single API attempts taking longer than 'call_timeout' seconds are retried as
+    transient errors.
+    """
+
+    def __init__(self, config=None, client=None, max_workers=64, call_timeout=None, **kwargs):
+        self.client = client or aws_api.Client(config, max_workers=max_workers, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='aws_api')
+        self.call_timeout = call_timeout
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    async def run(self, func, *args, **kwargs):
+        """Run blocking 'func' on the client's executor."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs))
+
+    async def safe_api_call(self, func, kwargs={}):
+        """Awaitable 'Client.safe_api_call': same retries, rate limiting and metrics."""
+        call = aws_api.APICall(self.client, func)
+        while True:
+            await asyncio.sleep(self.client.rate_limiter.reserve())
+            try:
+                response = await asyncio.wait_for(self.run(func, **kwargs), self.call_timeout)
+            except asyncio.TimeoutError:
+                await asyncio.sleep(call.failed(TimeoutError('no response in {}s'.format(self.call_timeout))))
+                continue
+            except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as err:
+                await asyncio.sleep(call.failed(err))
+                continue
+            if response['ResponseMetadata']['HTTPStatusCode'] == 200:
+                return call.succeeded(response)
+            await asyncio.sleep(call.failed(response))
+
+    async def get_ec2(self, region=None):
+        # The first client of a region takes a while to create, do not block the loop
+        return await self.run(self.client.get_ec2, region)
+
+    async def get_availability_zones(self, region=None):
+        return await self.run(self.client.get_availability_zones, region)
+
+    async def paginate(self, func, kwargs, result_key, page_size=None):
+        """Async generator of 'result_key' items from every page of a paginated API call."""
+        cursor = aws_api.PageCursor(kwargs, page_size)
+        while not cursor.done:
+            for item in cursor.advance(await self.safe_api_call(func, cursor.kwargs))[result_key]:
+                yield item
+
+    async def iter_spot_instance_requests(self, page_size=500):
+        ec2 = await self.get_ec2()
+        async for request in self.paginate(ec2.describe_spot_instance_requests,
+                                           {'Filters': self.client.get_user_filter()},
+                                           'SpotInstanceRequests', page_size):
+            yield request
+
+    async def iter_spot_instances(self, page_size=500):
+        ec2 = await self.get_ec2()
+        async for reservation in self.paginate(ec2.describe_instances, {'Filters': self.client.get_user_filter()},
+                                               'Reservations', page_size):
+            for instance in reservation['Instances']:
+                yield instance
+
+    async def iter_volumes(self, page_size=500):
+        ec2 = await self.get_ec2()
+        async for volume in self.paginate(ec2.describe_volumes, {'Filters': self.client.get_user_filter()},
+                                          'Volumes', page_size):
+            yield volume
+
+    async def list_spot_instance_requests(self, output='table', sort=True, file=None):
+        requests = [request async for request in self.iter_spot_instance_requests()]
+        return self.client.list_spot_instance_requests(output, sort, file, requests=requests)
+
+    async def list_spot_instances(self, output='table', sort=True, file=None):
+        instances = [instance async for instance in self.iter_spot_instances()]
+        return self.client.list_spot_instances(output, sort, file, instances=instances)
+
+    async def list_volumes(self, output='table', sort=True, file=None):
+        volumes = [volume async for volume in self.iter_volumes()]
+        return self.client.list_volumes(output, sort, file, volumes=volumes)
+
+    # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.describe_spot_price_history
+    async def fetch_zone_price_history(self, zone, kwargs, region=None):
+        """Page through raw spot price history records of a single availability zone."""
+        import price_store
+        ec2 = await self.get_ec2(region)
+        cursor = aws_api.PageCursor(dict(kwargs, AvailabilityZone=zone))
+        buffer = price_store.SeriesBuffer()
+        while not cursor.done:
+            page = cursor.advance(await self.safe_api_call(ec2.describe_spot_price_history, cursor.kwargs))
+            buffer.extend(*price_store.parse_price_page(page))
+        return buffer.to_series()
+
+    async def get_zone_price_records(self, zone, kwargs, region=None):
+        if self.client.price_store is not None:
+            # The store reads and writes files around fetching, keep it on the executor
+            return await self.run(self.client.get_zone_price_records, zone, kwargs, region)
+        return await self.fetch_zone_price_history(zone, kwargs, region)
+
+    async def get_zone_price_history(self, zone, kwargs, region=None):
+        import price_store
+        series = await self.get_zone_price_records(zone, kwargs, region)
+        return price_store.append_current_price(series, kwargs['EndTime'])
+
+    async def iter_price_history(self, profile, availability_zones, time_delta_days=7):
+        """Async generator of (zone, 'price_store.PriceSeries') pairs as soon as each zone is complete."""
+        kwargs = self.client.get_price_history_kwargs(profile, time_delta_days)
+
+        async def get(zone):
+            return zone, await self.get_zone_price_history(zone, kwargs)
+
+        tasks = [asyncio.ensure_future(get(zone)) for zone in availability_zones]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def get_price_history(self, profile, availability_zones, time_delta_days=7):
+        """Return a dict mapping 'availability_zones' to 'price_store.PriceSeries' columns."""
+        kwargs = self.client.get_price_history_kwargs(profile, time_delta_days)
+        with self.client.metrics.stage('get_price_history'):
+            series = await asyncio.gather(*[self.get_zone_price_history(zone, kwargs)
+                                            for zone in availability_zones])
+        return dict(zip(availability_zones, series))
+
+    async def bulk_api_call(self, func, ids, id_key, chunk_size=None, kwargs={}):
+        """Awaitable 'Client.bulk_api_call' running all the calls concurrently."""
+        groups = chunked(ids, chunk_size or 1)
+
+        async def call(group):
+            try:
+                return await self.safe_api_call(func, dict(kwargs, **{id_key: group if chunk_size else group[0]}))
+            except APIError as err:
+                return err
+
+        results = await asyncio.gather(*[call(group) for group in groups])
+        return {resource_id: result for group, result in zip(groups, results) for resource_id in group}
+
+    async def bulk_wait(self, waiter_name, ids, id_key, chunk_size=200):
+        return await self.run(self.client.bulk_wait, waiter_name, ids, id_key, chunk_size)
+
+    # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.create_tags
+    async def create_tags(self, resource_ids, tags, chunk_size=1000):
+        ec2 = await self.get_ec2()
+        return await asyncio.gather(*[self.safe_api_call(ec2.create_tags, {'Resources': chunk, 'Tags': tags})
+                                      for chunk in chunked(resource_ids, chunk_size)])
+
+    async def terminate_instances(self, instance_ids, wait=False, chunk_size=1000):
+        ec2 = await self.get_ec2()
+        results = await self.bulk_api_call(ec2.terminate_instances, instance_ids, 'InstanceIds', chunk_size)
+        self.client.cache.invalidate('instance_volumes')
+        if wait:
+            await self.bulk_wait('instance_terminated', [instance_id for instance_id in instance_ids
+                                                         if not isinstance(results[instance_id], APIError)],
+                                 'InstanceIds')
+        return results
+
+    async def reboot_instances(self, instance_ids, chunk_size=1000):
+        ec2 = await self.get_ec2()
+        return await self.bulk_api_call(ec2.reboot_instances, instance_ids, 'InstanceIds', chunk_size)
+
+    async def detach_volumes(self, volume_ids, force=False, wait=False):
+        ec2 = await self.get_ec2()
+        results = await self.bulk_api_call(ec2.detach_volume, volume_ids, 'VolumeId', kwargs={'Force': force})
+        self.client.cache.invalidate('instance_volumes')
+        if wait:
+            await self.bulk_wait('volume_available', [volume_id for volume_id in volume_ids
+                                                      if not isinstance(results[volume_id], APIError)], 'VolumeIds')
+        return results
+
+    async def delete_volumes(self, volume_ids, wait=False):
+        ec2 = await self.get_ec2()
+        results = await self.bulk_api_call(ec2.delete_volume, volume_ids, 'VolumeId')
+        self.client.cache.invalidate('instance_volumes')
+        if wait:
+            await self.bulk_wait('volume_deleted', [volume_id for volume_id in volume_ids
+                                                    if not isinstance(results[volume_id], APIError)], 'VolumeIds')
+        return results
+
+    async def iter_spot_request_fulfilment(self, request_ids, timeout=None, poll_min=1, poll_max=20):
+        """Async generator of 'Client.iter_spot_request_fulfilment', polling with 'asyncio.sleep'."""
+        ec2 = await self.get_ec2()
+        tracker = aws_api.FulfilmentTracker(request_ids, timeout, poll_min, poll_max)
+        while not tracker.done:
+            finished = tracker.update(await self.safe_api_call(ec2.describe_spot_instance_requests,
+                                                               tracker.get_kwargs()))
+            if len(finished) > 0:
+                yield finished
+            if tracker.done:
+                break
+            sleep = tracker.next_sleep()
+            if sleep is None:
+                yield tracker.expire()
+                break
+            await asyncio.sleep(sleep)
+
+    async def track_spot_requests(self, request_profiles, timeout=None):
+        """Awaitable 'Client.track_spot_requests', returning the latest state of all spot requests."""
+        requests = []
+        async for finished in self.iter_spot_request_fulfilment(list(request_profiles), timeout):
+            for profile, instance_ids in aws_api.get_profile_instances(finished, request_profiles).items():
+                volume_ids = await self.run(self.client.get_instance_volume_ids, instance_ids)
+                await self.create_tags([*instance_ids, *volume_ids], self.client.get_profile_tags(profile))
+            requests += finished
+        return requests
+
+    # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.request_spot_instances
+    async def request_spot_instances(self, profile, availability_zone, price, instance_count=1, valid_hours=None,
+                                     timeout=None):
+        """Awaitable 'Client.request_spot_instances'."""
+        ec2 = await self.get_ec2()
+        kwargs = self.client.get_spot_request_kwargs(profile, availability_zone, price, instance_count, valid_hours)
+        response = await self.safe_api_call(ec2.request_spot_instances, kwargs)
+        return await self.track_spot_requests({request['SpotInstanceRequestId']: profile
+                                               for request in response['SpotInstanceRequests']}, timeout)
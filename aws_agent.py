@@ -1,31 +1,83 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import utils
+import cache
 import aws_api
+import daemon
+import metrics
 
+# Commands reading spot price history, the only ones needing the price store
+PRICE_HISTORY_COMMANDS = ('daemon', 'printPriceHistory', 'plotPriceHistory', 'renderPriceHistory',
+                          'recommendPricing', 'watchPricing', 'recommendBatch', 'backtestBid', 'smartSpotRequest',
+                          'provision')
 
-if __name__ == '__main__':
+# Bulk commands selecting resources by id or with '--state', '--olderThan' and '--tag'
+SELECTION_COMMANDS = ('rebootInstances', 'terminateInstances', 'deleteVolumes', 'detachVolumes')
+
+
+def main():
     parser = utils.get_argparser()
     options = parser.parse_args()
+    if options.trace == 'chrome':
+        metrics.recorder.keep_events()
+    try:
+        run(parser, options)
+    finally:
+        if options.trace:
+            write_trace(options)
+
+
+def write_trace(options):
+    if options.traceFile:
+        with open(options.traceFile, 'w') as file:
+            metrics.recorder.write(options.trace, file)
+    else:
+        metrics.recorder.write(options.trace)
+
+
+def run(parser, options):
+    if options.subparser_name in SELECTION_COMMANDS and not (options.id or utils.has_selectors(options)):
+        parser.error('{}: give resource id(s) or select them with --state, --olderThan or --tag'.format(
+            options.subparser_name))
 
     config = utils.read_config(options.configPath)
-    aws_client = aws_api.Client(config)
+    config_digest = utils.get_config_digest(config['user_profile'], config['instance_profiles'])
+
+    # Answer from the resident agent's snapshot if it is running with the same config
+    if not options.noDaemon and options.subparser_name in daemon.COMMANDS:
+        output = daemon.try_request(options.socketPath, options.subparser_name,
+                                    dict(vars(options), configDigest=config_digest))
+        if output is not None:
+            sys.stdout.write(output)
+            return
+
+    store = None
+    if not options.noStore and options.subparser_name in PRICE_HISTORY_COMMANDS:
+        import price_store
+        store = price_store.PriceHistoryStore(options.storeDir)
+    response_cache = cache.ResponseCache(cache_dir=None if options.noCache else options.cacheDir)
+    aws_client = aws_api.Client(config, max_workers=options.maxWorkers, price_store=store,
+                                response_cache=response_cache)
 
     if options.subparser_name == 'listProfiles':
         aws_client.list_profiles()
 
+    elif options.subparser_name == 'daemon':
+        daemon.AgentDaemon(aws_client, options.socketPath, options.refresh).serve_forever()
+
     elif options.subparser_name == 'listAvailabilityZones':
         print('\n'.join(aws_client.get_availability_zones()))
 
     elif options.subparser_name == 'listRequests':
-        aws_client.list_spot_instance_requests()
+        aws_client.list_spot_instance_requests(options.output, not options.noSort)
 
     elif options.subparser_name == 'listInstances':
-        aws_client.list_spot_instances()
+        aws_client.list_spot_instances(options.output, not options.noSort)
 
     elif options.subparser_name == 'listVolumes':
-        aws_client.list_volumes()
+        aws_client.list_volumes(options.output, not options.noSort)
 
     elif options.subparser_name == 'attachVolume':
         volume_id = input('Enter volume id to attach: ')
@@ -41,11 +93,23 @@ if __name__ == '__main__':
     elif options.subparser_name == 'deleteVolume':
         aws_client.delete_volume(options.id)
 
+    elif options.subparser_name == 'deleteVolumes':
+        volume_ids = utils.select_resources(aws_client.select_volumes, options,
+                                            ['available', 'in-use'] if options.detach else ['available'])
+        aws_client.delete_volumes(volume_ids, options.detach, options.force, options.wait)
+
+    elif options.subparser_name == 'detachVolumes':
+        volume_ids = utils.select_resources(aws_client.select_volumes, options, ['in-use'])
+        aws_client.detach_volumes(volume_ids, options.force, options.wait)
+
     elif options.subparser_name == 'rebootInstances':
-        aws_client.reboot_instances(options.id)
+        instance_ids = utils.select_resources(aws_client.select_instances, options, ['running'])
+        aws_client.reboot_instances(instance_ids)
 
     elif options.subparser_name == 'terminateInstances':
-        aws_client.terminate_instances(options.id)
+        instance_ids = utils.select_resources(aws_client.select_instances, options,
+                                              ['pending', 'running', 'stopping', 'stopped'])
+        aws_client.terminate_instances(instance_ids, options.wait)
 
     elif options.subparser_name == 'printPriceHistory':
         profile = input('Enter profile name: ')
@@ -53,7 +117,7 @@ if __name__ == '__main__':
         period = input('Enter period in days to analyze: ')
         availability_zones = aws_client.get_availability_zones() if len(zone) == 0 else [zone]
         price_history = aws_client.get_price_history(profile, availability_zones, int(period))
-        utils.print_price_history(price_history)
+        utils.print_price_history(price_history, resolution=options.resolution)
 
     elif options.subparser_name == 'plotPriceHistory':
         profile = input('Enter profile name: ')
@@ -62,16 +126,54 @@ if __name__ == '__main__':
         plot_histogram = input('Do you want to plan a histogram (y/n): ')
         availability_zones = aws_client.get_availability_zones() if len(zone) == 0 else [zone]
         price_history = aws_client.get_price_history(profile, availability_zones, int(period))
-        utils.plot_price_history(price_history, True if plot_histogram == 'y' else False)
-        input('Price history plot for profile %s created...' % profile)
+        plot_kwargs = {'plot_hist': plot_histogram == 'y', 'resolution': options.resolution,
+                       'max_points': options.maxPoints, 'downsample': options.downsample}
+        if options.output:
+            print('\n'.join(utils.save_price_history_plot(price_history, options.output, **plot_kwargs)))
+        else:
+            utils.plot_price_history(price_history, **plot_kwargs)
+            input('Price history plot for profile %s created...' % profile)
+
+    elif options.subparser_name == 'renderPriceHistory':
+        profiles = options.profiles or list(config['instance_profiles'])
+        regions = options.regions or [aws_client.ec2.meta.region_name]
+        batch_history = aws_client.get_batch_price_history(profiles, regions, options.days)
+        os.makedirs(options.outputDir, exist_ok=True)
+        jobs = [(os.path.join(options.outputDir, '{}_{}.{}'.format(profile, region, options.format)), price_history)
+                for (region, profile), price_history in batch_history.items()]
+        paths = utils.save_price_history_plots(jobs, options.processes, plot_hist=options.histogram,
+                                               resolution=options.resolution, max_points=options.maxPoints,
+                                               downsample=options.downsample)
+        print('\n'.join(paths))
 
     elif options.subparser_name == 'recommendPricing':
         profile = options.profile
         availability_zones = aws_client.get_availability_zones()
         price_history = aws_client.get_price_history(profile, availability_zones)
-        rec_zone, rec_price = utils.get_recommended_pricing(price_history)
+        rec_zone, rec_price = utils.get_recommended_pricing(price_history, options.resolution)
         print('RECOMMENDED BIDDING (ZONE: {}, PRICE: {:.2f})'.format(rec_zone, rec_price))
 
+    elif options.subparser_name == 'watchPricing':
+        import streaming
+        recommender = streaming.StreamingRecommender(aws_client, options.profile, aws_client.get_availability_zones(),
+                                                     options.days, options.halfLife)
+        utils.watch_recommendations(recommender, options.interval)
+
+    elif options.subparser_name == 'recommendBatch':
+        profiles = options.profiles or list(config['instance_profiles'])
+        regions = options.regions or [aws_client.ec2.meta.region_name]
+        batch_history = aws_client.get_batch_price_history(profiles, regions, options.days)
+        utils.print_batch_recommendations(utils.get_batch_recommendations(batch_history, options.resolution))
+
+    elif options.subparser_name == 'backtestBid':
+        import backtest
+        availability_zones = aws_client.get_availability_zones()
+        price_history = aws_client.get_price_history(options.profile, availability_zones, options.days)
+        bids = options.bids if options.bids else backtest.get_bid_grid(price_history, options.steps)
+        with metrics.recorder.stage('backtest_bids'):
+            result = backtest.backtest_bids(price_history, bids)
+        utils.print_backtest(result, options.minRunFraction, show_all=bool(options.bids))
+
     elif options.subparser_name == 'requestInstances':
         profile = input('Enter profile name: ')
         availability_zone = input('Enter availability zone name: ')
@@ -81,7 +183,8 @@ if __name__ == '__main__':
         kwargs = {'profile': profile,
                   'availability_zone': availability_zone,
                   'price': price,
-                  'instance_count': instance_count}
+                  'instance_count': instance_count,
+                  'timeout': options.timeout}
         if len(valid_hours) > 0:
             kwargs['valid_hours'] = valid_hours
         response = aws_client.request_spot_instances(**kwargs)
@@ -93,18 +196,45 @@ if __name__ == '__main__':
         # Get recommended pricing and resource allocation options
         availability_zones = aws_client.get_availability_zones()
         price_history = aws_client.get_price_history(profile, availability_zones)
-        zone, price = utils.get_recommended_pricing(price_history)
+        zone, price = utils.get_recommended_pricing(price_history, options.resolution)
         # Request spot instance(s)
         kwargs = {'profile': profile,
                   'availability_zone': zone,
                   'price': price,
-                  'instance_count': instance_count}
+                  'instance_count': instance_count,
+                  'timeout': options.timeout}
         if len(valid_hours) > 0:
             kwargs['valid_hours'] = valid_hours
         print("Creating {} Spot request(s) in zone '{}' and bidding price {:<.2}".format(
             instance_count, zone, price))
         response = aws_client.request_spot_instances(**kwargs)
 
+    elif options.subparser_name == 'provision':
+        import provision
+        entries = provision.read_manifest(options.manifest, config['instance_profiles'])
+        # Recommend from a single batch of price history per profile, whatever the number of entries
+        profiles = list(dict.fromkeys(entry['profile'] for entry in entries if provision.needs_recommendation(entry)))
+        zones_stats = {}
+        if len(profiles) > 0:
+            batch_history = aws_client.get_batch_price_history(profiles, [None], options.days)
+            zones_stats = {profile: utils.get_zones_stats(price_history, options.resolution)
+                           for (region, profile), price_history in batch_history.items()}
+        allocations = provision.plan_allocations(entries, zones_stats)
+        utils.print_allocations(allocations)
+        if not options.dryRun and (options.yes or input('Proceed (y/n): ') == 'y'):
+            utils.print_provision_report(aws_client.request_spot_allocations(allocations, options.timeout))
+
     else:
         parser.print_usage()
         sys.exit(1)
+
+    if not options.noDaemon and options.subparser_name in daemon.MUTATING_COMMANDS:
+        daemon.try_request(options.socketPath, 'refresh', {'configDigest': config_digest})
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except aws_api.APIError as err:
+        print('AWS API error: {}'.format(err), file=sys.stderr)
+        sys.exit(1)
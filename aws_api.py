@@ -1,15 +1,149 @@
+import os
 import sys
 import time
+import uuid
+import threading
 import pytz
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-import boto3
 import botocore
-import numpy as np
+
+import retry
+import cache
+import listing
+import metrics
+from retry import APIError, ThrottlingError, FatalAPIError
+
+
+def chunked(items, size):
+    """Split 'items' into lists of at most 'size' items."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+# Spot request status codes that keep a request open but are not going to change soon
+# http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/spot-bid-status.html
+SPOT_HOLDING_CODES = {'price-too-low', 'capacity-not-available', 'capacity-oversubscribed',
+                      'constraint-not-fulfillable', 'launch-group-constraint', 'az-group-constraint',
+                      'placement-group-constraint'}
+
+
+class APICall:
+    """Retry state of a single API call made through 'client', shared by the sync and async clients."""
+
+    def __init__(self, client, func):
+        self.client = client
+        self.operation = getattr(func, '__name__', str(func))
+        self.start = time.perf_counter()
+        self.attempt = 0
+        self.throttles = 0
+
+    def succeeded(self, response):
+        self.client.rate_limiter.succeeded()
+        self.client.metrics.record_call(self.operation, self.start, self.attempt, self.throttles, response=response)
+        return response
+
+    def failed(self, error):
+        """Return seconds to wait before retrying after 'error' (an exception or a non-200 response).
+
+        Raise 'retry.FatalAPIError' on non-retryable errors and 'retry.APIError' (or
+        'retry.ThrottlingError') if it was the last attempt.
+        """
+        client = self.client
+        error_class, code, message = retry.classify_error(error)
+        if error_class is retry.FatalAPIError:
+            client.metrics.record_call(self.operation, self.start, self.attempt, self.throttles, error=code)
+            raise retry.FatalAPIError(self.operation, code, message)
+        backoff = client.backoff_base
+        if error_class is retry.ThrottlingError:
+            client.rate_limiter.throttled()
+            self.throttles += 1
+            backoff *= 4
+        print('[Try #{}] {}: {}: {}'.format(self.attempt + 1, self.operation, code, message), file=sys.stderr)
+        if self.attempt + 1 >= client.retry_tries:
+            client.metrics.record_call(self.operation, self.start, self.attempt, self.throttles, error=code)
+            raise error_class(self.operation, code, message)
+        self.attempt += 1
+        return retry.get_backoff(self.attempt - 1, backoff, client.backoff_max)
+
+
+class PageCursor:
+    """Arguments of the next page of a paginated API call, shared by the sync and async clients."""
+
+    def __init__(self, kwargs, page_size=None):
+        self.kwargs = dict(kwargs, MaxResults=page_size) if page_size else dict(kwargs)
+
+    @property
+    def done(self):
+        return self.kwargs is None
+
+    def advance(self, page):
+        """Move past 'page' and return it, the cursor is done after the last page."""
+        self.kwargs = dict(self.kwargs, NextToken=page['NextToken']) if page.get('NextToken') else None
+        return page
+
+
+class FulfilmentTracker:
+    """Spot requests tracked until fulfilled or unlikely to be soon, shared by the sync and async clients.
+
+    Requests become final when active, closed, cancelled, failed or held by a status code in
+    'SPOT_HOLDING_CODES'. Poll intervals grow from 'poll_min' to 'poll_max' seconds, polling
+    stops 'timeout' seconds after the tracker is created.
+    """
+
+    def __init__(self, request_ids, timeout=None, poll_min=1, poll_max=20):
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.pending = {request_id: None for request_id in request_ids}
+        self.interval = poll_min
+        self.poll_max = poll_max
+
+    @property
+    def done(self):
+        return len(self.pending) == 0
+
+    def get_kwargs(self):
+        return {'SpotInstanceRequestIds': list(self.pending)}
+
+    def update(self, response):
+        """Return requests of a 'describe_spot_instance_requests' response that became final."""
+        finished = []
+        for request in response['SpotInstanceRequests']:
+            self.pending[request['SpotInstanceRequestId']] = request
+            if request['State'] != 'open' or request['Status']['Code'] in SPOT_HOLDING_CODES:
+                finished.append(self.pending.pop(request['SpotInstanceRequestId']))
+        return finished
+
+    def next_sleep(self):
+        """Return seconds to wait before the next poll, None once the timeout expired."""
+        sleep = self.interval
+        if self.deadline is not None:
+            sleep = min(sleep, self.deadline - time.monotonic())
+            if sleep <= 0:
+                return None
+        self.interval = min(self.interval * 1.5, self.poll_max)
+        return sleep
+
+    def expire(self):
+        """Stop tracking and return the latest state of requests still pending."""
+        requests = [request for request in self.pending.values() if request is not None]
+        self.pending = {}
+        return requests
+
+
+def get_profile_instances(requests, request_profiles):
+    """Map profiles to instance ids of active 'requests', 'request_profiles' maps request ids to profiles."""
+    profile_instances = {}
+    for request in requests:
+        if request['State'] == 'active':
+            profile = request_profiles[request['SpotInstanceRequestId']]
+            profile_instances.setdefault(profile, []).append(request['InstanceId'])
+    return profile_instances
 
 
 class Client:
 
-    def __init__(self, config, time_zone='Europe/Kiev', retry_timeout=5, retry_tries=5):
+    def __init__(self, config, time_zone='Europe/Kiev', retry_tries=5, max_workers=8,
+                 price_store=None, backoff_base=0.5, backoff_max=20, rate_limit=20, response_cache=None,
+                 recorder=None):
         """Peform config checking and initialize Client's global variables."""
         # Ensure config contains 'instance_profiles' section
         assert 'instance_profiles' in config, "config does not have 'instance_profiles' section"
@@ -19,34 +153,46 @@ class Client:
         assert sum([tag["Key"] == 'User' and len(tag["Value"]) > 0 for tag in config[
                    'user_profile']['tags']]) == 1, "config does not contain username information"
 
-        self.ec2 = boto3.client('ec2')
+        # EC2 clients are created on first use, keyed by region (None for the default one)
+        self.regional_ec2 = {}
+        self.regional_ec2_lock = threading.Lock()
 
         self.inst_profiles = config["instance_profiles"]
         self.user_profile = config["user_profile"]
 
-        self.retry_timeout = retry_timeout
         self.retry_tries = retry_tries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = retry.RateLimiter(rate_limit)
+        self.max_workers = max_workers
+        self.price_store = price_store
+        # Slow-changing lookups are cached in memory only unless a shared cache is given
+        self.cache = response_cache or cache.ResponseCache()
+        # API calls and stages are recorded in the process-wide recorder unless given another one
+        self.metrics = recorder or metrics.recorder
         self.tz = pytz.timezone(time_zone)
 
     def safe_api_call(self, func, kwargs={}):
         """Boto3 API function call wrapper.
 
-        Handle Client and AWS API errors by performing 'self.retry_tries' attempts.
+        Calls of all threads are paced by the shared 'self.rate_limiter'. Throttled and
+        transient errors are retried up to 'self.retry_tries' times with exponential
+        backoff and jitter, throttling also slows the rate limiter down. Raise
+        'retry.FatalAPIError' on non-retryable errors and 'retry.APIError' (or
+        'retry.ThrottlingError') when all attempts failed. Every call is recorded in
+        'self.metrics' with its retries and throttles.
         """
-        for i in range(self.retry_tries):
+        call = APICall(self, func)
+        while True:
+            self.rate_limiter.acquire()
             try:
                 response = func(**kwargs)
-            except botocore.exceptions.ClientError as err:
-                err_name, error_desc = type(err).__name__, err
-            else:
-                if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-                    return response
-                else:
-                    err_name, error_desc = 'AWS Client', response[
-                        'ResponseMetadata']['HTTPStatusCode']
-            print('[Try #{}] {}: {}'.format(i + 1, err_name, error_desc))
-            time.sleep(self.retry_timeout)
-        sys.exit(1)
+            except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as err:
+                time.sleep(call.failed(err))
+                continue
+            if response['ResponseMetadata']['HTTPStatusCode'] == 200:
+                return call.succeeded(response)
+            time.sleep(call.failed(response))
 
     def get_user_filter(self):
         """Create a list of dicts containing user's tags to be passed as a filter."""
@@ -61,71 +207,130 @@ class Client:
             for key in self.inst_profiles[profile]:
                 print('\t{:23} {}'.format(key.upper(), self.inst_profiles[profile][key]))
 
+    @property
+    def ec2(self):
+        """EC2 client of the default region."""
+        return self.get_ec2()
+
+    @ec2.setter
+    def ec2(self, client):
+        self.regional_ec2[None] = client
+
+    def get_ec2(self, region=None):
+        """Return EC2 client of 'region' (default: current region), creating it on first use."""
+        client = self.regional_ec2.get(region)
+        if client is None:
+            # boto3 takes a while to import, commands not calling AWS never load it
+            import boto3
+            # boto3 default session is not thread-safe, serialize client creation
+            with self.regional_ec2_lock:
+                if region not in self.regional_ec2:
+                    self.regional_ec2[region] = boto3.client('ec2', region_name=region)
+                client = self.regional_ec2[region]
+        return client
+
+    @staticmethod
+    def get_credentials_name():
+        """Name the AWS credentials of boto3 clients from the environment variables selecting them."""
+        return os.environ.get('AWS_ACCESS_KEY_ID') or os.environ.get('AWS_PROFILE') or \
+            os.environ.get('AWS_DEFAULT_PROFILE') or 'default'
+
     # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.describe_availability_zones
-    def get_availability_zones(self):
-        response = self.safe_api_call(self.ec2.describe_availability_zones)
-        return sorted([zone['ZoneName'] for zone in response['AvailabilityZones'] if zone['State'] == 'available'])
+    def get_availability_zones(self, region=None):
+        ec2 = self.get_ec2(region)
+        # Zone names are mapped per account and the cache directory is shared by all of them
+        key = (self.get_credentials_name(), ec2.meta.region_name)
+        try:
+            return list(self.cache.get('availability_zones', key))
+        except KeyError:
+            pass
+        response = self.safe_api_call(ec2.describe_availability_zones)
+        zones = sorted([zone['ZoneName'] for zone in response['AvailabilityZones'] if zone['State'] == 'available'])
+        self.cache.put('availability_zones', key, zones)
+        return list(zones)
+
+    def paginate(self, func, kwargs, result_key, page_size=None):
+        """Yield items of 'result_key' list from every page of a paginated API call."""
+        cursor = PageCursor(kwargs, page_size)
+        while not cursor.done:
+            yield from cursor.advance(self.safe_api_call(func, cursor.kwargs))[result_key]
+
+    def format_time(self, dt):
+        return (dt or datetime(1970, 1, 1, tzinfo=self.tz)).astimezone(self.tz).strftime("%d-%m-%Y %H:%M:%S")
+
+    def write_listing(self, fields, header_format, row_format, keyed_rows, output, sort, file=None):
+        """Write (sort key, row) pairs, sorted by key with bounded memory if 'sort' is set."""
+        if sort:
+            keyed_rows = listing.bounded_sort(keyed_rows, key=lambda keyed_row: keyed_row[0])
+        rows = (row for key, row in keyed_rows)
+        return listing.write_rows(fields, header_format, row_format, rows, output, file)
 
     # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.describe_spot_instance_requests
-    def list_spot_instance_requests(self):
-        response = self.safe_api_call(self.ec2.describe_spot_instance_requests, {
-                                      'Filters': self.get_user_filter()})
+    def iter_spot_instance_requests(self, page_size=500):
+        return self.paginate(self.ec2.describe_spot_instance_requests, {'Filters': self.get_user_filter()},
+                             'SpotInstanceRequests', page_size)
+
+    def list_spot_instance_requests(self, output='table', sort=True, file=None, requests=None):
+        """Write user's requests (default: listed from AWS) to 'file' (default: stdout)."""
         fields = ['CreateTime', 'RequestID', "Price",
                   'InstanceID', 'ValidUntill', 'State', 'RequestStatus']
-        print('{:21}{:15}{:7}{:13}{:21}{:9}{}'.format(*fields))
-        for request in sorted(response['SpotInstanceRequests'], key=lambda request: request['CreateTime']):
-            # row = [request.get('CreateTime', datetime(1970, 1,
-            # 1)).astimezone(self.tz).strftime("%d-%m-%Y %H:%M:%S"),
-            row = [request.get('CreateTime', datetime(1970, 1, 1, tzinfo=self.tz)).astimezone(self.tz).strftime("%d-%m-%Y %H:%M:%S"),
-                   request.get('SpotInstanceRequestId', ''),
-                   float(request.get('SpotPrice', 'inf')),
-                   request.get('InstanceId', ''),
-                   request.get('ValidUntil', datetime(1970, 1, 1, tzinfo=self.tz)
-                               ).astimezone(self.tz).strftime("%d-%m-%Y %H:%M:%S"),
-                   request.get('State', '').upper(),
-                   request.get('Status', {}).get('Message', '')]
-            print('{:21}{:15}{:<7.2g}{:13}{:21}{:9}{}'.format(*row))
-        return response
+        keyed_rows = ((request.get('CreateTime', datetime(1970, 1, 1, tzinfo=self.tz)).timestamp(),
+                       [self.format_time(request.get('CreateTime')),
+                        request.get('SpotInstanceRequestId', ''),
+                        float(request.get('SpotPrice', 'inf')),
+                        request.get('InstanceId', ''),
+                        self.format_time(request.get('ValidUntil')),
+                        request.get('State', '').upper(),
+                        request.get('Status', {}).get('Message', '')])
+                      for request in (requests if requests is not None else self.iter_spot_instance_requests()))
+        return self.write_listing(fields, '{:21}{:15}{:7}{:13}{:21}{:9}{}', '{:21}{:15}{:<7.2g}{:13}{:21}{:9}{}',
+                                  keyed_rows, output, sort, file)
 
     # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.describe_instances
-    def list_spot_instances(self):
-        response = self.safe_api_call(self.ec2.describe_instances, {
-                                      'Filters': self.get_user_filter()})
+    def iter_spot_instances(self, page_size=500):
+        for reservation in self.paginate(self.ec2.describe_instances, {'Filters': self.get_user_filter()},
+                                         'Reservations', page_size):
+            yield from reservation['Instances']
+
+    def list_spot_instances(self, output='table', sort=True, file=None, instances=None):
+        """Write user's instances (default: listed from AWS) to 'file' (default: stdout)."""
         fields = ['LaunchTime', 'InstanceID', 'ImageID', 'Zone',
                   'InstanceType', 'PublicIP', 'PrivateIP', 'KeyName', 'State']
-        print('{:21}{:13}{:15}{:13}{:14}{:16}{:16}{:15}{:10}'.format(*fields))
-        for reservation in sorted(response['Reservations'], key=lambda reservation: reservation['Instances'][0]['LaunchTime']):
-            for instance in reservation['Instances']:
-                row = [instance.get('LaunchTime', datetime(1970, 1, 1, tzinfo=self.tz)).astimezone(self.tz).strftime("%d-%m-%Y %H:%M:%S"),
-                       instance.get('InstanceId', ''),
-                       instance.get('ImageId', ''),
-                       instance.get('Placement', {}).get('AvailabilityZone', ''),
-                       instance.get('InstanceType', ''),
-                       instance.get('PublicIpAddress', ''),
-                       instance.get('PrivateIpAddress', ''),
-                       instance.get('KeyName', ''),
-                       instance.get('State', {}).get('Name', '').upper()]
-                print('{:21}{:13}{:15}{:13}{:14}{:16}{:16}{:15}{:10}'.format(*row))
-        return response
+        keyed_rows = ((instance.get('LaunchTime', datetime(1970, 1, 1, tzinfo=self.tz)).timestamp(),
+                       [self.format_time(instance.get('LaunchTime')),
+                        instance.get('InstanceId', ''),
+                        instance.get('ImageId', ''),
+                        instance.get('Placement', {}).get('AvailabilityZone', ''),
+                        instance.get('InstanceType', ''),
+                        instance.get('PublicIpAddress', ''),
+                        instance.get('PrivateIpAddress', ''),
+                        instance.get('KeyName', ''),
+                        instance.get('State', {}).get('Name', '').upper()])
+                      for instance in (instances if instances is not None else self.iter_spot_instances()))
+        row_format = '{:21}{:13}{:15}{:13}{:14}{:16}{:16}{:15}{:10}'
+        return self.write_listing(fields, row_format, row_format, keyed_rows, output, sort, file)
 
     # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.describe_volumes
-    def list_volumes(self):
-        response = self.safe_api_call(self.ec2.describe_volumes, {
-            'Filters': self.get_user_filter()})
+    def iter_volumes(self, page_size=500):
+        return self.paginate(self.ec2.describe_volumes, {'Filters': self.get_user_filter()},
+                             'Volumes', page_size)
+
+    def list_volumes(self, output='table', sort=True, file=None, volumes=None):
+        """Write user's volumes (default: listed from AWS) to 'file' (default: stdout)."""
         fields = ['CreateTime', 'VolumeId', "Size", 'Type', 'Iops', 'Zone', 'InstanceId', 'State']
-        print('{:21}{:15}{:6}{:6}{:6}{:13}{:15}{:10}'.format(*fields))
-        for volume in sorted(response['Volumes'], key=lambda volume: volume['CreateTime']):
-            row = [volume.get('CreateTime', datetime(1970, 1, 1, tzinfo=self.tz)).astimezone(self.tz).strftime("%d-%m-%Y %H:%M:%S"),
-                   volume.get('VolumeId', ''),
-                   volume.get('Size', ''),
-                   volume.get('VolumeType', ''),
-                   volume.get('Iops', ''),
-                   volume.get('AvailabilityZone', ''),
-                   ','.join([attch.get('InstanceId', '')
-                             for attch in volume.get('Attachments', [])]),
-                   volume.get('State', '')]
-            print('{:21}{:15}{:<6}{:6}{:<6}{:13}{:15}{:10}'.format(*row))
-        return response
+        keyed_rows = ((volume.get('CreateTime', datetime(1970, 1, 1, tzinfo=self.tz)).timestamp(),
+                       [self.format_time(volume.get('CreateTime')),
+                        volume.get('VolumeId', ''),
+                        volume.get('Size', ''),
+                        volume.get('VolumeType', ''),
+                        volume.get('Iops', ''),
+                        volume.get('AvailabilityZone', ''),
+                        ','.join([attch.get('InstanceId', '')
+                                  for attch in volume.get('Attachments', [])]),
+                        volume.get('State', '')])
+                      for volume in (volumes if volumes is not None else self.iter_volumes()))
+        return self.write_listing(fields, '{:21}{:15}{:6}{:6}{:6}{:13}{:15}{:10}',
+                                  '{:21}{:15}{:<6}{:6}{:<6}{:13}{:15}{:10}', keyed_rows, output, sort, file)
 
     # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.attach_volume
     def attach_volume(self, instance_id, volume_id, device):
@@ -133,6 +338,7 @@ class Client:
                   'VolumeId': volume_id,
                   'Device': device}
         response = self.safe_api_call(self.ec2.attach_volume, kwargs)
+        self.cache.invalidate('instance_volumes')
         print('State: {}'.format(response['State']))
         return response
 
@@ -141,46 +347,154 @@ class Client:
         kwargs = {'VolumeId': volume_id,
                   'Force': force}
         response = self.safe_api_call(self.ec2.detach_volume, kwargs)
+        self.cache.invalidate('instance_volumes')
         print('State: {}'.format(response['State']))
         return response
 
     # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.delete_volume
     def delete_volume(self, volume_id):
-        return self.safe_api_call(self.ec2.delete_volume, {'VolumeId': volume_id})
+        response = self.safe_api_call(self.ec2.delete_volume, {'VolumeId': volume_id})
+        self.cache.invalidate('instance_volumes')
+        return response
 
     # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.describe_spot_price_history
-    def get_price_history(self, profile, availability_zones, time_delta_days=7):
-        instance_type = self.inst_profiles[profile]['instance_type']
-        product = self.inst_profiles[profile]['product']
-
-        end_time = self.tz.localize(datetime.today())
+    def fetch_zone_price_history(self, zone, kwargs, region=None):
+        """Page through raw spot price history records of a single availability zone."""
+        import price_store
+        ec2 = self.get_ec2(region)
+        cursor = PageCursor(dict(kwargs, AvailabilityZone=zone))
+        buffer = price_store.SeriesBuffer()
+        while not cursor.done:
+            page = cursor.advance(self.safe_api_call(ec2.describe_spot_price_history, cursor.kwargs))
+            buffer.extend(*price_store.parse_price_page(page))
+        return buffer.to_series()
+
+    def get_zone_price_records(self, zone, kwargs, region=None):
+        """Get published spot price records of a single availability zone, using 'self.price_store' if set."""
+        if self.price_store is None:
+            return self.fetch_zone_price_history(zone, kwargs, region)
+        key = (self.get_ec2(region).meta.region_name, kwargs['InstanceTypes'][0],
+               kwargs['ProductDescriptions'][0], zone)
+        return self.price_store.get_price_series(
+            key, kwargs['StartTime'],
+            lambda start_time: self.fetch_zone_price_history(zone, dict(kwargs, StartTime=start_time), region))
+
+    def get_zone_price_history(self, zone, kwargs, region=None):
+        """Get spot price history of a single availability zone, the last price holding until 'EndTime'."""
+        import price_store
+        return price_store.append_current_price(self.get_zone_price_records(zone, kwargs, region), kwargs['EndTime'])
+
+    def get_price_history_kwargs(self, profile, time_delta_days):
+        # 'self.tz' is for display only, query times are the current UTC time
+        end_time = datetime.now(pytz.utc)
         start_time = end_time - timedelta(days=time_delta_days)
+        return {'StartTime': start_time,
+                'EndTime': end_time,
+                'InstanceTypes': [self.inst_profiles[profile]['instance_type']],
+                'ProductDescriptions': [self.inst_profiles[profile]['product']]}
 
-        price_history = {}
-        # TODO: to be rewritten using 'safe_api_call'
-        paginator = self.ec2.get_paginator('describe_spot_price_history')
-        for zone in availability_zones:
-            price_list = []
-            for page in paginator.paginate(StartTime=start_time,
-                                           EndTime=end_time,
-                                           InstanceTypes=[instance_type],
-                                           ProductDescriptions=[product],
-                                           AvailabilityZone=zone):
-                price_list += [(float(i['SpotPrice']), i['Timestamp'])
-                               for i in page['SpotPriceHistory']]
-                price_list = [(price_list[0][0], end_time)] + \
-                    price_list  # set last available price as current
-            price_history[zone] = np.array(
-                price_list, dtype=[('price', np.float), ('timestamp', 'datetime64[h]')])
-        return price_history
+    def iter_price_history(self, profile, availability_zones, time_delta_days=7, max_workers=None):
+        """Fetch spot price history for all 'availability_zones' concurrently.
+
+        Zones are paged in parallel by a pool of at most 'max_workers' threads
+        (defaults to 'self.max_workers'), each request going through 'safe_api_call'.
+        Yield (zone, 'price_store.PriceSeries') pairs as soon as each zone is complete.
+        """
+        kwargs = self.get_price_history_kwargs(profile, time_delta_days)
+        max_workers = max(1, min(max_workers or self.max_workers, len(availability_zones)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(self.get_zone_price_history, zone, kwargs): zone
+                       for zone in availability_zones}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def get_price_history(self, profile, availability_zones, time_delta_days=7, max_workers=None):
+        """Return a dict mapping 'availability_zones' to 'price_store.PriceSeries' columns."""
+        with self.metrics.stage('get_price_history'):
+            price_history = dict(self.iter_price_history(
+                profile, availability_zones, time_delta_days, max_workers))
+        return {zone: price_history[zone] for zone in availability_zones}
+
+    def get_batch_price_history(self, profiles, regions, time_delta_days=7, max_workers=None):
+        """Fetch spot price history of every profile in every zone of 'regions' concurrently.
+
+        All (region, profile, zone) queries share a single pool of at most 'max_workers'
+        threads, using one EC2 client per region.
+        Return a dict mapping (region, profile) to 'get_price_history'-like dicts.
+        """
+        max_workers = max(1, max_workers or self.max_workers)
+        with self.metrics.stage('get_batch_price_history'), ThreadPoolExecutor(max_workers=max_workers) as executor:
+            region_zones = dict(zip(regions, executor.map(self.get_availability_zones, regions)))
+            futures = {}
+            for region in regions:
+                for profile in profiles:
+                    kwargs = self.get_price_history_kwargs(profile, time_delta_days)
+                    for zone in region_zones[region]:
+                        futures[(region, profile, zone)] = executor.submit(
+                            self.get_zone_price_history, zone, kwargs, region)
+            batch_history = {(region, profile): {} for region in regions for profile in profiles}
+            for (region, profile, zone), future in futures.items():
+                batch_history[(region, profile)][zone] = future.result()
+        return batch_history
 
     # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.create_tags
-    def create_tags(self, resource_ids, tags):
-        return self.safe_api_call(self.ec2.create_tags, {'Resources': resource_ids, 'Tags': tags})
+    def create_tags(self, resource_ids, tags, chunk_size=1000):
+        """Tag resources issuing calls of at most 'chunk_size' resources concurrently."""
+        chunks = chunked(resource_ids, chunk_size)
+        max_workers = max(1, min(self.max_workers, len(chunks)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda chunk: self.safe_api_call(
+                self.ec2.create_tags, {'Resources': chunk, 'Tags': tags}), chunks))
 
-    # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.request_spot_instances
-    def request_spot_instances(self, profile, availability_zone, price, instance_count=1, valid_hours=None):
-        kwargs = {'SpotPrice': str(price),
+    # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.describe_spot_instance_requests
+    def iter_spot_request_fulfilment(self, request_ids, timeout=None, poll_min=1, poll_max=20):
+        """Track spot requests until each of them is fulfilled or will not be fulfilled soon.
+
+        Yield lists of requests that became final since the previous poll, see
+        'FulfilmentTracker'. Requests still pending after 'timeout' seconds are yielded
+        last with their latest state.
+        """
+        tracker = FulfilmentTracker(request_ids, timeout, poll_min, poll_max)
+        while not tracker.done:
+            finished = tracker.update(self.safe_api_call(self.ec2.describe_spot_instance_requests,
+                                                         tracker.get_kwargs()))
+            if len(finished) > 0:
+                yield finished
+            if tracker.done:
+                break
+            sleep = tracker.next_sleep()
+            if sleep is None:
+                yield tracker.expire()
+                break
+            sys.stdout.write("."), sys.stdout.flush()
+            with self.metrics.stage('spot_request_polling'):
+                time.sleep(sleep)
+
+    def get_instance_volume_ids(self, instance_ids, chunk_size=1000):
+        """Return EBS volumes id(s) attached to 'instance_ids', only describing instances not cached yet."""
+        instance_volumes = {key[0]: volume_ids for key, volume_ids in
+                            self.cache.get_many('instance_volumes', [(i,) for i in instance_ids]).items()}
+        missing = [instance_id for instance_id in instance_ids if instance_id not in instance_volumes]
+        fetched = {}
+        for chunk in chunked(missing, chunk_size):
+            for reservation in self.paginate(self.ec2.describe_instances, {'InstanceIds': chunk}, 'Reservations'):
+                for instance in reservation['Instances']:
+                    fetched[instance['InstanceId']] = [mapping['Ebs']['VolumeId']
+                                                       for mapping in instance['BlockDeviceMappings']
+                                                       if 'Ebs' in mapping]
+        self.cache.put_many('instance_volumes', {(instance_id,): volume_ids
+                                                 for instance_id, volume_ids in fetched.items()})
+        instance_volumes.update(fetched)
+        return [volume_id for instance_id in instance_ids for volume_id in instance_volumes.get(instance_id, [])]
+
+    def get_spot_request_kwargs(self, profile, availability_zone, price, instance_count=1, valid_hours=None):
+        """Return 'request_spot_instances' arguments, requests get tagged with 'profile' tags on creation.
+
+        A new 'ClientToken' identifies the submission: retries of a call that timed out or
+        failed after reaching AWS return the spot requests already created instead of new ones.
+        """
+        kwargs = {'ClientToken': str(uuid.uuid4()),
+                  'SpotPrice': str(price),
                   'Type': 'one-time',
                   'InstanceCount': int(instance_count),
                   'LaunchSpecification': {'ImageId': self.inst_profiles[profile]['image_id'],
@@ -193,58 +507,213 @@ class Client:
                   }
         if valid_hours:
             kwargs['ValidUntil'] = datetime.today() + timedelta(hours=int(valid_hours))
+        # Tag spot request(s) on creation, launch specification does not support tagging instances
+        kwargs['TagSpecifications'] = [{'ResourceType': 'spot-instances-request',
+                                        'Tags': self.get_profile_tags(profile)}]
+        return kwargs
+
+    # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.request_spot_instances
+    def request_spot_instances(self, profile, availability_zone, price, instance_count=1, valid_hours=None,
+                               timeout=None):
+        """Request spot instances, tagging every instance and its volumes as soon as it is running.
 
+        Spot requests are tagged on creation, instances and volumes with chunked concurrent calls.
+
+        Stop waiting for fulfilment after 'timeout' seconds (default: never) leaving pending
+        requests open. Return the latest state of all spot requests.
+        """
+        kwargs = self.get_spot_request_kwargs(profile, availability_zone, price, instance_count, valid_hours)
         response = self.safe_api_call(self.ec2.request_spot_instances, kwargs)
+        return self.track_spot_requests({request['SpotInstanceRequestId']: profile
+                                         for request in response['SpotInstanceRequests']}, timeout)
 
-        # Tag spot request(s)
-        request_ids = [request['SpotInstanceRequestId']
-                       for request in response['SpotInstanceRequests']]
-        tags = self.get_profile_tags(profile)
-        self.create_tags(request_ids, tags)
+    def track_spot_requests(self, request_profiles, timeout=None):
+        """Report spot requests fulfilment, tagging instances and volumes with their profile tags.
 
-        # Wait for all Spot request(s) to be processed by Amazon
+        'request_profiles' maps spot request ids to profiles. Return the latest state of all
+        spot requests as 'iter_spot_request_fulfilment' leaves them.
+        """
         print('Waiting for your Spot request(s) to be evaluated')
-        states_list = ['open']
-        while 'open' in states_list:
-            sys.stdout.write("."), time.sleep(self.retry_timeout)
-            response = self.safe_api_call(self.ec2.describe_spot_instance_requests, {
-                                          'SpotInstanceRequestIds': request_ids})
-            states_list = [request['State'] for request in response['SpotInstanceRequests']]
+        requests = []
+        for finished in self.iter_spot_request_fulfilment(list(request_profiles), timeout):
+            print('')
+            for request in finished:
+                print('{}: {}'.format(request['SpotInstanceRequestId'], request['Status']['Message']))
+            for profile, instance_ids in get_profile_instances(finished, request_profiles).items():
+                self.create_tags([*instance_ids, *self.get_instance_volume_ids(instance_ids)],
+                                 self.get_profile_tags(profile))
+                print('Instance(s) [{}] tagged'.format(', '.join(instance_ids)))
+            requests += finished
         print('done')
+        still_open = [request['SpotInstanceRequestId'] for request in requests if request['State'] == 'open']
+        if len(still_open) > 0:
+            print('Spot request(s) [{}] are still open: instances launched later will not be tagged '
+                  'and will not show up in listings, cancel them if not needed'.format(', '.join(still_open)))
 
-        # Get spot instance id(s)
-        instance_ids = []
-        for request in response['SpotInstanceRequests']:
-            print(request['Status']['Message'])
-            if request['State'] == 'active':
-                instance_ids.append(request['InstanceId'])
-
-        # Get EBS volumes id(s)
-        volume_ids = []
-        response = self.safe_api_call(self.ec2.describe_instances, {
-            'InstanceIds': instance_ids})
-        for reservation in response['Reservations']:
-            for instance in reservation['Instances']:
-                for mapping in instance['BlockDeviceMappings']:
-                    if 'Ebs' in mapping:
-                        volume_ids.append(mapping['Ebs']['VolumeId'])
-
-        # Tag spot instance(s)
-        if len(instance_ids) > 0:
-            tags = self.get_profile_tags(profile)
-            self.create_tags([*instance_ids, *volume_ids], tags)
+        return requests
 
-        return response
+    def request_spot_allocations(self, allocations, timeout=None):
+        """Submit spot requests of all 'allocations' concurrently and track them in a single loop.
+
+        'allocations' are 'provision.Allocation' tuples. Return a dict mapping every allocation
+        to the latest state of its spot requests or the 'APIError' its submission failed with.
+        """
+        def submit(allocation):
+            kwargs = self.get_spot_request_kwargs(allocation.profile, allocation.zone, allocation.price,
+                                                  allocation.count, allocation.valid_hours)
+            try:
+                response = self.safe_api_call(self.ec2.request_spot_instances, kwargs)
+            except APIError as err:
+                return err
+            return [request['SpotInstanceRequestId'] for request in response['SpotInstanceRequests']]
+
+        max_workers = max(1, min(self.max_workers, len(allocations)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            submitted = dict(zip(allocations, executor.map(submit, allocations)))
+
+        request_allocations = {request_id: allocation for allocation, request_ids in submitted.items()
+                               if not isinstance(request_ids, APIError) for request_id in request_ids}
+        requests = self.track_spot_requests({request_id: allocation.profile
+                                             for request_id, allocation in request_allocations.items()}, timeout)
+        results = {allocation: request_ids if isinstance(request_ids, APIError) else []
+                   for allocation, request_ids in submitted.items()}
+        for request in requests:
+            results[request_allocations[request['SpotInstanceRequestId']]].append(request)
+        return results
+
+    def get_selection_filters(self, tags=None, older_than_hours=None):
+        """Return user's filters extended with 'tags' dict and creation time cutoff (or None)."""
+        filters = self.get_user_filter() + [{'Name': 'tag:' + key, 'Values': [value]}
+                                            for key, value in (tags or {}).items()]
+        cutoff = None
+        if older_than_hours is not None:
+            cutoff = datetime.now(pytz.utc) - timedelta(hours=older_than_hours)
+        return filters, cutoff
+
+    def select_instances(self, instance_ids=None, states=None, older_than_hours=None, tags=None):
+        """Return ids of user's instances matching all of the given criteria."""
+        filters, cutoff = self.get_selection_filters(tags, older_than_hours)
+        if states:
+            filters.append({'Name': 'instance-state-name', 'Values': states})
+        kwargs = {'Filters': filters}
+        if instance_ids:
+            kwargs['InstanceIds'] = instance_ids
+        return [instance['InstanceId']
+                for reservation in self.paginate(self.ec2.describe_instances, kwargs, 'Reservations')
+                for instance in reservation['Instances']
+                if cutoff is None or instance['LaunchTime'] < cutoff]
+
+    def select_volumes(self, volume_ids=None, states=None, older_than_hours=None, tags=None):
+        """Return ids of user's volumes matching all of the given criteria."""
+        filters, cutoff = self.get_selection_filters(tags, older_than_hours)
+        if states:
+            filters.append({'Name': 'status', 'Values': states})
+        kwargs = {'Filters': filters}
+        if volume_ids:
+            kwargs['VolumeIds'] = volume_ids
+        return [volume['VolumeId'] for volume in self.paginate(self.ec2.describe_volumes, kwargs, 'Volumes')
+                if cutoff is None or volume['CreateTime'] < cutoff]
+
+    def bulk_api_call(self, func, ids, id_key, chunk_size=None, kwargs={}):
+        """Call 'func' for every id of 'ids' on a bounded thread pool.
+
+        Ids are passed under 'id_key' as lists of at most 'chunk_size' ids, or one by one
+        if 'chunk_size' is None. Return a dict mapping every id to the response of its
+        call or the 'APIError' it failed with.
+        """
+        groups = chunked(ids, chunk_size or 1)
+
+        def call(group):
+            try:
+                return self.safe_api_call(func, dict(kwargs, **{id_key: group if chunk_size else group[0]}))
+            except APIError as err:
+                return err
+
+        max_workers = max(1, min(self.max_workers, len(groups)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return {resource_id: result
+                    for group, result in zip(groups, executor.map(call, groups))
+                    for resource_id in group}
+
+    # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#waiters
+    def bulk_wait(self, waiter_name, ids, id_key, chunk_size=200):
+        """Wait for 'ids' to reach the state of 'waiter_name' boto3 waiter in concurrent chunks.
+
+        Return a dict mapping every id to None or the 'botocore.exceptions.WaiterError' it failed with.
+        """
+        waiter = self.ec2.get_waiter(waiter_name)
+        groups = chunked(ids, chunk_size)
+
+        def wait(group):
+            try:
+                # Waiters poll on their own, bypassing 'safe_api_call'
+                with self.metrics.stage('wait:' + waiter_name):
+                    waiter.wait(**{id_key: group})
+            except botocore.exceptions.WaiterError as err:
+                return err
+
+        max_workers = max(1, min(self.max_workers, len(groups)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return {resource_id: result
+                    for group, result in zip(groups, executor.map(wait, groups))
+                    for resource_id in group}
+
+    def print_bulk_results(self, results, describe=lambda resource_id, response: 'OK'):
+        """Print outcome of a bulk operation per resource, return ids of failed ones."""
+        failed = []
+        for resource_id, result in results.items():
+            if isinstance(result, Exception):
+                print('{}: FAILED ({})'.format(resource_id, result))
+                failed.append(resource_id)
+            else:
+                print('{}: {}'.format(resource_id, describe(resource_id, result)))
+        return failed
 
     # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.terminate_instances
-    def terminate_instances(self, instance_ids):
-        response = self.safe_api_call(self.ec2.terminate_instances, {'InstanceIds': instance_ids})
-        for instance in response['TerminatingInstances']:
-            print('{}: {}'.format(instance['InstanceId'], instance['CurrentState']['Name']))
-        return response
+    def terminate_instances(self, instance_ids, wait=False, chunk_size=1000):
+        results = self.bulk_api_call(self.ec2.terminate_instances, instance_ids, 'InstanceIds', chunk_size)
+        self.cache.invalidate('instance_volumes')
+        failed = self.print_bulk_results(results, lambda instance_id, response: next(
+            instance['CurrentState']['Name'] for instance in response['TerminatingInstances']
+            if instance['InstanceId'] == instance_id))
+        if wait:
+            print('Waiting for instance(s) to terminate')
+            instance_ids = [instance_id for instance_id in instance_ids if instance_id not in failed]
+            self.print_bulk_results(self.bulk_wait('instance_terminated', instance_ids, 'InstanceIds'),
+                                    lambda instance_id, response: 'terminated')
+        return results
 
     # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.reboot_instances
-    def reboot_instances(self, instance_ids):
-        response = self.safe_api_call(self.ec2.reboot_instances, {'InstanceIds': instance_ids})
-        print('Instance(s) [{}] rebooted'.format(', '.join(instance_ids)))
-        return response
+    def reboot_instances(self, instance_ids, chunk_size=1000):
+        results = self.bulk_api_call(self.ec2.reboot_instances, instance_ids, 'InstanceIds', chunk_size)
+        self.print_bulk_results(results, lambda instance_id, response: 'rebooted')
+        return results
+
+    def detach_volumes(self, volume_ids, force=False, wait=False):
+        results = self.bulk_api_call(self.ec2.detach_volume, volume_ids, 'VolumeId', kwargs={'Force': force})
+        self.cache.invalidate('instance_volumes')
+        failed = self.print_bulk_results(results, lambda volume_id, response: response['State'])
+        if wait:
+            print('Waiting for volume(s) to become available')
+            volume_ids = [volume_id for volume_id in volume_ids if volume_id not in failed]
+            self.print_bulk_results(self.bulk_wait('volume_available', volume_ids, 'VolumeIds'),
+                                    lambda volume_id, response: 'available')
+        return results
+
+    def delete_volumes(self, volume_ids, detach=False, force=False, wait=False):
+        """Delete volumes, detaching those in use first if 'detach' is set."""
+        if detach:
+            in_use = [volume['VolumeId'] for chunk in chunked(volume_ids, 200)
+                      for volume in self.paginate(self.ec2.describe_volumes, {'VolumeIds': chunk}, 'Volumes')
+                      if volume['State'] == 'in-use']
+            if len(in_use) > 0:
+                self.detach_volumes(in_use, force, wait=True)
+        results = self.bulk_api_call(self.ec2.delete_volume, volume_ids, 'VolumeId')
+        self.cache.invalidate('instance_volumes')
+        failed = self.print_bulk_results(results, lambda volume_id, response: 'deleting')
+        if wait:
+            print('Waiting for volume(s) to be deleted')
+            volume_ids = [volume_id for volume_id in volume_ids if volume_id not in failed]
+            self.print_bulk_results(self.bulk_wait('volume_deleted', volume_ids, 'VolumeIds'),
+                                    lambda volume_id, response: 'deleted')
+        return results
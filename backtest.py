@@ -0,0 +1,83 @@
+from collections import namedtuple
+
+import numpy as np
+
+
+# Outcome of every (zone, bid) pair: arrays are shaped (len(zones), len(bids))
+BacktestResult = namedtuple('BacktestResult', ['zones', 'bids', 'run_fraction', 'interruptions',
+                                               'mean_run_hours', 'cost'])
+
+
+def count_below(values, bids):
+    """Count 'values' less than or equal to each of 'bids'."""
+    return np.searchsorted(np.sort(values), bids, side='right')
+
+
+def backtest_zone(series, bids):
+    """Replay a zone's price history against every bid of 'bids' at once.
+
+    Spot prices are treated as a step function: each record holds until the next one,
+    and an instance bidding 'bid' runs while the price is not above it and pays the price.
+    Return (run_fraction, interruptions, mean_run_hours, cost) arrays shaped like 'bids'.
+    """
+    # Every record but the last (current price) holds until the next one
+    price = np.asarray(series.price[:-1], np.float64)
+    hours = np.diff(series.timestamp).astype('timedelta64[s]').astype(np.float64) / 3600
+    total_hours = np.sum(hours)
+
+    # Run time and cost are cumulative sums over records ordered by price
+    order = np.argsort(price, kind='stable')
+    run_hours = np.append(0, np.cumsum(hours[order]))
+    cost_sums = np.append(0, np.cumsum(price[order] * hours[order]))
+    running = count_below(price, bids)
+    run_hours, cost = run_hours[running], cost_sums[running]
+
+    # A rise from 'prev' to 'curr' interrupts bids in [prev, curr), a drop resumes bids in [curr, prev)
+    prev, curr = series.price[:-1], series.price[1:]
+    rise, drop = curr > prev, curr < prev
+    interruptions = count_below(prev[rise], bids) - count_below(curr[rise], bids)
+    resumes = count_below(curr[drop], bids) - count_below(prev[drop], bids)
+    runs = resumes + (series.price[0] <= bids)
+
+    run_fraction = run_hours / total_hours if total_hours > 0 else np.zeros_like(bids)
+    mean_run_hours = run_hours / np.maximum(runs, 1)
+    return run_fraction, interruptions, mean_run_hours, cost
+
+
+def backtest_bids(price_history, bids):
+    """Backtest a grid of 'bids' against every zone of 'price_history'.
+
+    'price_history' maps zones to 'price_store.PriceSeries' as returned by
+    'Client.get_price_history'. Zones without at least two records are skipped.
+    """
+    bids = np.asarray(bids, np.float64)
+    zones = sorted(zone for zone, series in price_history.items() if series.price.size > 1)
+    results = [backtest_zone(price_history[zone], bids) for zone in zones]
+    # Without zones there is no result to transpose, every column is empty
+    columns = zip(*results) if len(results) > 0 else [[]] * 4
+    return BacktestResult(zones, bids, *[np.array(column, np.float64).reshape(len(zones), bids.size)
+                                         for column in columns])
+
+
+def get_bid_grid(price_history, steps=1000):
+    """Return 'steps' evenly spaced candidate bids covering all prices of 'price_history'."""
+    prices = [series.price for series in price_history.values() if series.price.size > 0]
+    if len(prices) == 0:
+        return np.empty(0)
+    low, high = min(np.min(p) for p in prices), max(np.max(p) for p in prices)
+    return np.linspace(low, high, steps)
+
+
+def get_cheapest_bids(result, min_run_fraction=0.99):
+    """For every zone find the lowest bid running at least 'min_run_fraction' of the time.
+
+    Return a list of (zone, bid index) sorted by the cost of running at that bid,
+    zones never reaching 'min_run_fraction' are omitted.
+    """
+    cheapest = []
+    for i, zone in enumerate(result.zones):
+        candidates = np.flatnonzero(result.run_fraction[i] >= min_run_fraction)
+        if candidates.size > 0:
+            cheapest.append((zone, candidates[0]))
+    zone_index = {zone: i for i, zone in enumerate(result.zones)}
+    return sorted(cheapest, key=lambda x: result.cost[zone_index[x[0]], x[1]])
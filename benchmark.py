@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import sys
+import json
+import argparse
+import contextlib
+import statistics
+import subprocess
+import time
+import tracemalloc
+from unittest import mock
+from datetime import datetime, timedelta
+
+import pytz
+import numpy as np
+
+import utils
+import aws_api
+import aws_agent
+import fake_ec2
+import streaming
+
+
+class StubEC2:
+    """Minimal stand-in for the boto3 EC2 client serving pre-built spot price history pages."""
+
+    def __init__(self, num_pages, page_size):
+        end_time = datetime.now(pytz.utc)
+        self.pages = []
+        for i in range(num_pages):
+            records = [{'SpotPrice': '{:.4f}'.format(0.1 + (j % 13) / 100),
+                        'Timestamp': end_time - timedelta(minutes=i * page_size + j)}
+                       for j in range(page_size)]
+            page = {'ResponseMetadata': {'HTTPStatusCode': 200}, 'SpotPriceHistory': records}
+            if i + 1 < num_pages:
+                page['NextToken'] = str(i + 1)
+            self.pages.append(page)
+
+    def describe_spot_price_history(self, **kwargs):
+        return self.pages[int(kwargs.get('NextToken', 0))]
+
+
+def legacy_ingest(pages, end_time):
+    """Page ingestion as originally done in 'Client.get_price_history'."""
+    price_list = []
+    for page in pages:
+        price_list += [(float(i['SpotPrice']), i['Timestamp'])
+                       for i in page['SpotPriceHistory']]
+        price_list = [(price_list[0][0], end_time)] + price_list
+    return np.array(price_list, dtype=[('price', np.float64), ('timestamp', 'datetime64[h]')])
+
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def bench_ingest(options):
+    stub = StubEC2(options.pages, options.pageSize)
+    # Stubbed calls are not rate limited by AWS, do not limit them either
+    client = aws_api.Client(utils.read_config(options.configPath), rate_limit=1e9)
+    client.ec2 = stub
+    kwargs = {'StartTime': None, 'EndTime': None}
+
+    print('Ingesting {} pages x {} records'.format(options.pages, options.pageSize))
+    print('{:12}{:.3f}s'.format('legacy', timeit(legacy_ingest, stub.pages, datetime.now(pytz.utc))))
+    print('{:12}{:.3f}s'.format('streaming', timeit(client.fetch_zone_price_history, 'zone', kwargs)))
+
+
+def get_startup_commands(options):
+    """Command lines timed in a new interpreter: top-level help and a command not calling AWS."""
+    return [['--help'], ['--configPath', options.configPath, 'listProfiles']]
+
+
+def get_aws_commands(profile):
+    """Commands calling AWS, timed in-process against the synthetic account."""
+    return [['listAvailabilityZones'], ['listRequests'], ['listInstances'], ['listVolumes'],
+            ['recommendPricing', profile], ['backtestBid', profile, '--days', '7']]
+
+
+def run_agent(args):
+    """Run 'aws_agent.main' with command line 'args', discarding its output."""
+    with mock.patch.object(sys, 'argv', ['aws_agent.py'] + args), contextlib.redirect_stdout(io.StringIO()):
+        aws_agent.main()
+
+
+def bench_startup(options):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aws_agent.py')
+    print('{:50}{}'.format('Command', 'Median (ms)'))
+    for args in get_startup_commands(options):
+        timings = []
+        for _ in range(options.repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, script] + args, stdout=subprocess.DEVNULL, check=True)
+            timings.append((time.perf_counter() - start) * 1000)
+        print('{:50}{:.0f}'.format(' '.join(args), statistics.median(timings)))
+
+    # Every client the agent creates talks to the synthetic account instead of AWS, the
+    # daemon, price store and shared cache are bypassed so every run makes its API calls
+    config = utils.read_config(options.configPath)
+    common = ['--configPath', options.configPath, '--noDaemon', '--noStore', '--noCache']
+    fake = fake_ec2.FakeEC2(config['user_profile']['tags'], days=7, num_instances=options.instances,
+                            num_volumes=2 * options.instances)
+    with mock.patch.object(aws_api.Client, 'get_ec2', lambda client, region=None: fake):
+        for args in get_aws_commands(next(iter(config['instance_profiles']))):
+            timings = [timeit(run_agent, common + args) * 1000 for _ in range(options.repeat)]
+            print('{:50}{:.0f}'.format(' '.join(args) + ' (in-process)', statistics.median(timings)))
+
+
+def get_suite(client, fake, options):
+    """Return (name, function) pairs of the suite, functions return the number of items processed."""
+    profile = next(iter(client.inst_profiles))
+    state = {}
+
+    def get_price_history():
+        state['price_history'] = client.get_price_history(profile, fake.zones, options.days)
+        return sum(series.price.size for series in state['price_history'].values())
+
+    def get_recommended_pricing():
+        utils.get_recommended_pricing(state['price_history'])
+        return len(state['price_history'])
+
+    def print_price_history():
+        with contextlib.redirect_stdout(io.StringIO()):
+            utils.print_price_history(state['price_history'])
+        return len(state['price_history'])
+
+    def poll_streaming_recommender():
+        # The first poll loads the whole window, the timed ones only fetch new records
+        if 'recommender' not in state:
+            state['recommender'] = streaming.StreamingRecommender(client, profile, fake.zones, options.days)
+            state['recommender'].poll()
+        return len(state['recommender'].poll())
+
+    def request_spot_instances():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return len(client.request_spot_instances(profile, fake.zones[0], 0.5, options.requestCount))
+
+    return [('get_price_history', get_price_history),
+            ('get_recommended_pricing', get_recommended_pricing),
+            ('print_price_history', print_price_history),
+            ('poll_streaming_recommender', poll_streaming_recommender),
+            ('list_spot_instances', lambda: client.list_spot_instances(file=io.StringIO())),
+            ('list_volumes', lambda: client.list_volumes(file=io.StringIO())),
+            ('list_spot_instance_requests', lambda: client.list_spot_instance_requests(file=io.StringIO())),
+            ('request_spot_instances', request_spot_instances)]
+
+
+def measure(func, fake, repeat):
+    """Return median time, throughput, API calls and peak traced memory of 'func' runs."""
+    timings = []
+    for _ in range(repeat):
+        calls = sum(fake.calls.values())
+        start = time.perf_counter()
+        items = func()
+        timings.append(time.perf_counter() - start)
+        calls = sum(fake.calls.values()) - calls
+    # Tracing slows allocations down, measure memory on a separate run
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    seconds = statistics.median(timings)
+    return {'seconds': seconds, 'items_per_sec': items / seconds if seconds > 0 else 0,
+            'calls': calls, 'peak_mb': peak / 2 ** 20}
+
+
+def get_regressions(result, baseline, tolerance):
+    """Return names of metrics of 'result' worse than 'baseline' by more than 'tolerance' fraction."""
+    return [metric for metric in ('seconds', 'calls', 'peak_mb')
+            if result[metric] > baseline[metric] * (1 + tolerance)]
+
+
+def bench_suite(options):
+    config = utils.read_config(options.configPath)
+    params = {name: getattr(options, name) for name in ('zones', 'days', 'recordMinutes', 'instances', 'volumes',
+                                                        'requestCount', 'latency', 'throttleRate', 'rateLimit')}
+    print('Synthesizing account: {}'.format(', '.join('{}={}'.format(*item) for item in params.items())))
+    fake = fake_ec2.FakeEC2(config['user_profile']['tags'], num_zones=options.zones, days=options.days,
+                            record_minutes=options.recordMinutes, num_instances=options.instances,
+                            num_volumes=options.volumes, latency=options.latency / 1000,
+                            throttle_rate=options.throttleRate)
+    client = aws_api.Client(config, rate_limit=options.rateLimit)
+    client.ec2 = fake
+
+    baseline = {}
+    if not options.saveBaseline and os.path.exists(options.baseline):
+        with open(options.baseline) as file:
+            saved = json.load(file)
+        if saved['params'] == params:
+            baseline = saved['results']
+        else:
+            print('Baseline {} was recorded with other parameters, not comparing'.format(options.baseline))
+
+    fields = ['Benchmark', 'Seconds', 'Items/s', 'Calls', 'Peak MB', 'Baseline']
+    print('{:30}{:10}{:12}{:8}{:10}{}'.format(*fields))
+    results, regressed = {}, False
+    for name, func in get_suite(client, fake, options):
+        result = results[name] = measure(func, fake, options.repeat)
+        status = ''
+        if name in baseline:
+            regressions = get_regressions(result, baseline[name], options.tolerance)
+            regressed = regressed or len(regressions) > 0
+            status = 'REGRESSION ({})'.format(', '.join(regressions)) if regressions else \
+                '{:+.0f}%'.format((result['seconds'] / baseline[name]['seconds'] - 1) * 100)
+        row = [name, result['seconds'], result['items_per_sec'], result['calls'], result['peak_mb'], status]
+        print('{:30}{:<10.3f}{:<12.0f}{:<8}{:<10.1f}{}'.format(*row))
+
+    if options.saveBaseline:
+        with open(options.baseline, 'w') as file:
+            json.dump({'params': params, 'results': results}, file, indent=2)
+        print('Baseline saved to {}'.format(options.baseline))
+    return not regressed
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(formatter_class=utils.Formatter,
+                                     description='AWS Agent performance benchmarks')
+    parser.add_argument('--configPath', default='config.json', metavar='FILEPATH',
+                        help='path to the config file (default: %(default)s)')
+    subparsers = parser.add_subparsers(dest='subparser_name', metavar="", title='benchmarks')
+
+    ingest = subparsers.add_parser('ingest', formatter_class=utils.Formatter,
+                                   help='spot price history page ingestion')
+    ingest.add_argument('--pages', default=2000, type=int, help='number of pages (default: %(default)s)')
+    ingest.add_argument('--pageSize', default=100, type=int, help='records per page (default: %(default)s)')
+
+    startup = subparsers.add_parser('startup', formatter_class=utils.Formatter,
+                                    help='command line startup and AWS commands run time')
+    startup.add_argument('--repeat', default=5, type=int, help='runs per command (default: %(default)s)')
+    startup.add_argument('--instances', default=1000, type=int,
+                         help='number of instances of the synthetic account (default: %(default)s)')
+
+    suite = subparsers.add_parser('suite', formatter_class=utils.Formatter,
+                                  help='aws_api.Client and utils analytics against a synthetic account')
+    suite.add_argument('--zones', default=6, type=int, help='availability zones (default: %(default)s)')
+    suite.add_argument('--days', default=90, type=int, help='days of price history (default: %(default)s)')
+    suite.add_argument('--recordMinutes', default=10, type=float, metavar='MINUTES',
+                       help='mean time between price records (default: %(default)s)')
+    suite.add_argument('--instances', default=5000, type=int, help='number of instances (default: %(default)s)')
+    suite.add_argument('--volumes', default=10000, type=int, help='number of volumes (default: %(default)s)')
+    suite.add_argument('--requestCount', default=100, type=int, metavar='N',
+                       help='instances requested by the spot request benchmark (default: %(default)s)')
+    suite.add_argument('--latency', default=20, type=float, metavar='MS',
+                       help='simulated latency of every API call (default: %(default)s)')
+    suite.add_argument('--throttleRate', default=0, type=float, metavar='FRACTION',
+                       help='fraction of API calls failing with RequestLimitExceeded (default: %(default)s)')
+    suite.add_argument('--rateLimit', default=100, type=float, metavar='CALLS',
+                       help="client's API calls per second limit (default: %(default)s)")
+    suite.add_argument('--repeat', default=3, type=int, help='timed runs per benchmark (default: %(default)s)')
+    suite.add_argument('--baseline', default='benchmark_baseline.json', metavar='FILEPATH',
+                       help='baseline results to compare with (default: %(default)s)')
+    suite.add_argument('--saveBaseline', action='store_true', help='save results as the new baseline')
+    suite.add_argument('--tolerance', default=0.25, type=float, metavar='FRACTION',
+                       help='slowdown or growth flagged as a regression (default: %(default)s)')
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = get_argparser()
+    options = parser.parse_args()
+
+    if options.subparser_name == 'ingest':
+        bench_ingest(options)
+    elif options.subparser_name == 'startup':
+        bench_startup(options)
+    elif options.subparser_name == 'suite':
+        if not bench_suite(options):
+            sys.exit(1)
+    else:
+        parser.print_usage()
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Seconds lookups of every cached operation stay valid, operations without a TTL are not cached
+DEFAULT_TTLS = {'availability_zones': 24 * 3600,
+                'instance_volumes': 3600}
+
+
+class ResponseCache:
+    """Thread-safe cache of slow-changing API lookups with a TTL per operation.
+
+    Entries are kept in an in-process LRU of at most 'max_size' entries. If 'cache_dir'
+    is given, they are also stored in a JSON file per operation there, so command line
+    invocations share them. Keys are tuples of strings, values must be JSON serializable.
+    """
+
+    def __init__(self, ttls=None, max_size=4096, cache_dir=None):
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.max_size = max_size
+        self.cache_dir = os.path.expanduser(cache_dir) if cache_dir else None
+        # (operation, key) -> (expiration time, value), least recently used first
+        self.entries = OrderedDict()
+        self.loaded = set()
+        self.lock = threading.RLock()
+
+    def get_path(self, operation):
+        return os.path.join(self.cache_dir, operation + '.json')
+
+    def read(self, operation):
+        """Return unexpired on-disk entries of 'operation' as a dict."""
+        try:
+            with open(self.get_path(operation)) as file:
+                entries = json.load(file)
+        except (IOError, ValueError):
+            return {}
+        now = time.time()
+        return {tuple(key): (expires, value) for key, expires, value in entries if expires > now}
+
+    def write(self, operation, updates):
+        """Merge 'updates' into on-disk entries of 'operation'.
+
+        Concurrent invocations may overwrite each other's updates, which only costs a refetch.
+        """
+        entries = self.read(operation)
+        entries.update(updates)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'w') as file:
+            json.dump([[key, expires, value] for key, (expires, value) in entries.items()], file)
+        os.replace(tmp_path, self.get_path(operation))
+
+    def load(self, operation):
+        """Bring on-disk entries of 'operation' into memory once."""
+        if self.cache_dir is None or operation in self.loaded:
+            return
+        self.loaded.add(operation)
+        for key, entry in self.read(operation).items():
+            self.entries.setdefault((operation, key), entry)
+        self.trim()
+
+    def trim(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get_many(self, operation, keys):
+        """Return a dict of cached values of 'keys' skipping missing and expired ones."""
+        now = time.time()
+        found = {}
+        with self.lock:
+            self.load(operation)
+            for key in keys:
+                entry = self.entries.get((operation, key))
+                if entry is None:
+                    continue
+                if entry[0] <= now:
+                    del self.entries[(operation, key)]
+                    continue
+                self.entries.move_to_end((operation, key))
+                found[key] = entry[1]
+        return found
+
+    def get(self, operation, key):
+        """Return cached value of 'key', raise KeyError if it is missing or expired."""
+        return self.get_many(operation, [key])[key]
+
+    def put_many(self, operation, items):
+        """Cache values of 'items' dict for the TTL of 'operation'."""
+        ttl = self.ttls.get(operation, 0)
+        if ttl <= 0 or len(items) == 0:
+            return
+        expires = time.time() + ttl
+        updates = {key: (expires, value) for key, value in items.items()}
+        with self.lock:
+            self.load(operation)
+            for key, entry in updates.items():
+                self.entries[(operation, key)] = entry
+                self.entries.move_to_end((operation, key))
+            self.trim()
+            if self.cache_dir is not None:
+                self.write(operation, updates)
+
+    def put(self, operation, key, value):
+        self.put_many(operation, {key: value})
+
+    def invalidate(self, *operations):
+        """Drop all entries of 'operations' in memory and on disk."""
+        with self.lock:
+            for entry_key in [entry_key for entry_key in self.entries if entry_key[0] in operations]:
+                del self.entries[entry_key]
+            if self.cache_dir is not None:
+                for operation in operations:
+                    try:
+                        os.remove(self.get_path(operation))
+                    except FileNotFoundError:
+                        pass
@@ -0,0 +1,151 @@
+import io
+import os
+import json
+import time
+import socket
+import threading
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+
+# Commands the daemon answers from its in-memory snapshot
+COMMANDS = ('listInstances', 'listVolumes', 'listRequests', 'listAvailabilityZones', 'recommendPricing')
+# Commands changing the inventory, the daemon is asked to refresh after them
+MUTATING_COMMANDS = ('requestInstances', 'smartSpotRequest', 'rebootInstances', 'terminateInstances',
+                     'attachVolume', 'detachVolume', 'deleteVolume', 'detachVolumes', 'deleteVolumes', 'provision')
+
+
+def request(socket_path, command, args=None, timeout=30):
+    """Send a command to a running daemon and return its decoded reply.
+
+    Raise OSError if no daemon is listening on 'socket_path'.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(os.path.expanduser(socket_path))
+        sock.sendall((json.dumps({'command': command, 'args': args or {}}) + '\n').encode())
+        with sock.makefile('r') as file:
+            return json.loads(file.readline())
+
+
+def try_request(socket_path, command, args=None):
+    """Return output of 'command' answered by the daemon or None if it is not available."""
+    try:
+        reply = request(socket_path, command, args)
+    except (OSError, ValueError):
+        return None
+    return reply['output'] if reply.get('status') == 'ok' else None
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline().decode())
+            reply = {'status': 'ok', 'output': self.server.agent.handle(message['command'], message['args'])}
+        except Exception as err:
+            reply = {'status': 'error', 'error': '{}: {}'.format(type(err).__name__, err)}
+        self.wfile.write((json.dumps(reply) + '\n').encode())
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class AgentDaemon:
+    """Resident agent keeping a warm 'aws_api.Client' and a live inventory of user's resources.
+
+    Instances, volumes and spot requests are re-listed in full in the background every
+    'refresh_interval' seconds (or on demand after mutating commands) and swapped in
+    atomically. Price history is kept for 'refresh_interval' seconds per profile,
+    refreshes only download new records when the client has a price store.
+    Commands are only answered for callers whose config digest matches the daemon's
+    user and instance profiles and AWS profile, region and credentials environment,
+    others get an error and query AWS directly.
+    The 'metrics' command returns the client's API call statistics as JSON for monitoring.
+    """
+
+    inventory_kinds = {'instances': 'iter_spot_instances',
+                       'volumes': 'iter_volumes',
+                       'requests': 'iter_spot_instance_requests'}
+
+    def __init__(self, client, socket_path, refresh_interval=60):
+        self.client = client
+        self.socket_path = os.path.expanduser(socket_path)
+        self.refresh_interval = refresh_interval
+        self.inventory = {}
+        self.price_history = {}
+        self.availability_zones = None
+        self.refresh_event = threading.Event()
+        self.config_digest = utils.get_config_digest(client.user_profile, client.inst_profiles)
+
+    def refresh(self):
+        with ThreadPoolExecutor(max_workers=len(self.inventory_kinds) + 1) as executor:
+            futures = {kind: executor.submit(lambda method: list(getattr(self.client, method)()), method)
+                       for kind, method in self.inventory_kinds.items()}
+            zones = executor.submit(self.client.get_availability_zones)
+            inventory = {kind: future.result() for kind, future in futures.items()}
+            self.availability_zones = zones.result()
+        self.inventory = inventory
+
+    def refresh_loop(self):
+        while True:
+            self.refresh_event.wait(self.refresh_interval)
+            self.refresh_event.clear()
+            try:
+                self.refresh()
+            except Exception as err:
+                print('Inventory refresh failed: {}'.format(err))
+
+    def get_price_history(self, profile, time_delta_days=7):
+        key = (profile, time_delta_days)
+        timestamp, price_history = self.price_history.get(key, (0, None))
+        if time.monotonic() - timestamp > self.refresh_interval:
+            price_history = self.client.get_price_history(profile, self.availability_zones, time_delta_days)
+            self.price_history[key] = (time.monotonic(), price_history)
+        return price_history
+
+    def handle(self, command, args):
+        """Execute 'command' with parsed command line 'args' and return its output."""
+        if command != 'metrics' and args.get('configDigest') != self.config_digest:
+            raise ValueError('daemon serves another config or AWS environment')
+        file = io.StringIO()
+        listing_args = {'output': args.get('output', 'table'), 'sort': not args.get('noSort'), 'file': file}
+        if command == 'listInstances':
+            self.client.list_spot_instances(instances=self.inventory['instances'], **listing_args)
+        elif command == 'listVolumes':
+            self.client.list_volumes(volumes=self.inventory['volumes'], **listing_args)
+        elif command == 'listRequests':
+            self.client.list_spot_instance_requests(requests=self.inventory['requests'], **listing_args)
+        elif command == 'listAvailabilityZones':
+            print('\n'.join(self.availability_zones), file=file)
+        elif command == 'recommendPricing':
+            price_history = self.get_price_history(args['profile'])
+            rec_zone, rec_price = utils.get_recommended_pricing(price_history, args.get('resolution'))
+            print('RECOMMENDED BIDDING (ZONE: {}, PRICE: {:.2f})'.format(rec_zone, rec_price), file=file)
+        elif command == 'refresh':
+            self.refresh_event.set()
+        elif command == 'metrics':
+            json.dump(self.client.metrics.snapshot(), file)
+        else:
+            raise ValueError('unsupported command {}'.format(command))
+        return file.getvalue()
+
+    def serve_forever(self):
+        print('Loading inventory')
+        self.refresh()
+        threading.Thread(target=self.refresh_loop, daemon=True).start()
+
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = Server(self.socket_path, RequestHandler)
+        server.agent = self
+        os.chmod(self.socket_path, 0o600)
+        print('Listening on {}'.format(self.socket_path))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(self.socket_path)
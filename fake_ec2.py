@@ -0,0 +1,215 @@
+import time
+import random
+import threading
+from datetime import datetime, timedelta
+
+import pytz
+import numpy as np
+import botocore.exceptions
+
+
+class Meta:
+
+    def __init__(self, region_name):
+        self.region_name = region_name
+
+
+class FakeEC2:
+    """In-process stand-in for the boto3 EC2 client serving a synthetic account.
+
+    The account holds 'num_instances' instances with a volume each, 'num_volumes' volumes in
+    total, a spot request per instance and 'days' of spot price history in every zone with
+    a record every 'record_minutes' on average. Resources carry 'tags' so user filters match.
+
+    Every call sleeps 'latency' seconds and fails with 'RequestLimitExceeded' with
+    probability 'throttle_rate'. Spot requests are fulfilled after 'fulfil_polls'
+    describe calls, submissions sharing a 'ClientToken' return the same requests.
+    Calls per operation are counted in 'self.calls'.
+    """
+
+    def __init__(self, tags, region='us-east-1', num_zones=6, days=90, record_minutes=10, num_instances=1000,
+                 num_volumes=2000, latency=0, throttle_rate=0, fulfil_polls=1, seed=0):
+        self.meta = Meta(region)
+        self.zones = ['{}{}'.format(region, chr(ord('a') + i)) for i in range(num_zones)]
+        self.tags = list(tags)
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.fulfil_polls = fulfil_polls
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.now = datetime.now(pytz.utc)
+
+        rng = np.random.RandomState(seed)
+        self.price_history = {zone: self.make_price_series(rng, days, record_minutes) for zone in self.zones}
+
+        self.instances, self.volumes, self.requests = {}, {}, {}
+        # ClientToken -> spot requests created by that submission
+        self.submissions = {}
+        for i in range(num_instances):
+            self.add_instance(self.zones[i % num_zones], self.now - timedelta(minutes=i))
+        for i in range(len(self.volumes), num_volumes):
+            self.add_volume(self.zones[i % num_zones], self.now - timedelta(minutes=i))
+
+    def make_price_series(self, rng, days, record_minutes):
+        """Random walk of spot prices sorted from the latest record, as AWS returns them."""
+        count = int(days * 24 * 60 / record_minutes)
+        steps = rng.exponential(record_minutes * 60, count).astype(np.int64)
+        timestamp = np.int64(self.now.timestamp()) - np.cumsum(steps)
+        price = np.round(np.clip(0.3 + np.cumsum(rng.normal(0, 0.01, count)), 0.05, 5), 4)
+        return price, timestamp
+
+    def add_volume(self, zone, create_time, instance_id=None):
+        volume_id = 'vol-{:017x}'.format(len(self.volumes))
+        self.volumes[volume_id] = {
+            'VolumeId': volume_id, 'Size': 8, 'VolumeType': 'gp2', 'AvailabilityZone': zone,
+            'CreateTime': create_time, 'State': 'in-use' if instance_id else 'available', 'Tags': self.tags,
+            'Attachments': [{'InstanceId': instance_id, 'VolumeId': volume_id, 'State': 'attached'}]
+            if instance_id else []}
+        return volume_id
+
+    def add_instance(self, zone, launch_time, instance_type='g2.2xlarge', request_id=None):
+        instance_id = 'i-{:017x}'.format(len(self.instances))
+        volume_id = self.add_volume(zone, launch_time, instance_id)
+        request_id = request_id or 'sir-{:08x}'.format(len(self.requests))
+        self.instances[instance_id] = {
+            'InstanceId': instance_id, 'ImageId': 'ami-fce3c696', 'InstanceType': instance_type,
+            'Placement': {'AvailabilityZone': zone}, 'LaunchTime': launch_time, 'KeyName': 'SSH_KEY',
+            'PrivateIpAddress': '10.0.{}.{}'.format(len(self.instances) // 256 % 256, len(self.instances) % 256),
+            'State': {'Name': 'running'}, 'Tags': self.tags, 'SpotInstanceRequestId': request_id,
+            'BlockDeviceMappings': [{'DeviceName': '/dev/sda1', 'Ebs': {'VolumeId': volume_id}}]}
+        if request_id not in self.requests:
+            self.requests[request_id] = {
+                'SpotInstanceRequestId': request_id, 'SpotPrice': '0.5', 'CreateTime': launch_time,
+                'State': 'active', 'InstanceId': instance_id, 'Tags': self.tags,
+                'Status': {'Code': 'fulfilled', 'Message': 'Your Spot request is fulfilled.'}}
+        return instance_id
+
+    def call(self, operation):
+        """Account for an API call, simulating its latency and throttling."""
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            throttled = self.random.random() < self.throttle_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'RequestLimitExceeded', 'Message': 'Request limit exceeded.'}}, operation)
+
+    @staticmethod
+    def response(**kwargs):
+        return dict(kwargs, ResponseMetadata={'HTTPStatusCode': 200})
+
+    @staticmethod
+    def matches(resource, filters, attributes):
+        """Check 'resource' against EC2 'filters', 'attributes' maps filter names to getters."""
+        tags = {tag['Key']: tag['Value'] for tag in resource.get('Tags', [])}
+        for item in filters:
+            if item['Name'].startswith('tag:'):
+                value = tags.get(item['Name'][4:])
+            else:
+                value = attributes[item['Name']](resource)
+            if value not in item['Values']:
+                return False
+        return True
+
+    def page(self, resources, result_key, kwargs, default_size=1000):
+        start = int(kwargs.get('NextToken') or 0)
+        end = start + kwargs.get('MaxResults', default_size)
+        page = self.response(**{result_key: resources[start:end]})
+        if end < len(resources):
+            page['NextToken'] = str(end)
+        return page
+
+    def select(self, resources, ids, filters, attributes):
+        with self.lock:
+            selected = [resources[i] for i in ids if i in resources] if ids else list(resources.values())
+        return [resource for resource in selected if self.matches(resource, filters or [], attributes)]
+
+    def describe_availability_zones(self, **kwargs):
+        self.call('DescribeAvailabilityZones')
+        return self.response(AvailabilityZones=[{'ZoneName': zone, 'State': 'available'} for zone in self.zones])
+
+    def describe_spot_price_history(self, **kwargs):
+        self.call('DescribeSpotPriceHistory')
+        price, timestamp = self.price_history[kwargs['AvailabilityZone']]
+        # Records are sorted from the latest one, select those within [StartTime, EndTime]
+        first = np.searchsorted(-timestamp, -kwargs['EndTime'].timestamp()) if kwargs.get('EndTime') else 0
+        last = np.searchsorted(-timestamp, -kwargs['StartTime'].timestamp(), side='right') \
+            if kwargs.get('StartTime') else timestamp.size
+        start = first + int(kwargs.get('NextToken') or 0)
+        end = min(start + kwargs.get('MaxResults', 1000), last)
+        records = [{'AvailabilityZone': kwargs['AvailabilityZone'],
+                    'InstanceType': kwargs.get('InstanceTypes', ['g2.2xlarge'])[0],
+                    'ProductDescription': kwargs.get('ProductDescriptions', ['Linux/UNIX'])[0],
+                    'SpotPrice': '{:.6f}'.format(price[i]),
+                    'Timestamp': datetime.fromtimestamp(timestamp[i], pytz.utc)} for i in range(start, end)]
+        page = self.response(SpotPriceHistory=records)
+        if end < last:
+            page['NextToken'] = str(end - first)
+        return page
+
+    def describe_instances(self, **kwargs):
+        self.call('DescribeInstances')
+        instances = self.select(self.instances, kwargs.get('InstanceIds'), kwargs.get('Filters'),
+                                {'instance-state-name': lambda instance: instance['State']['Name']})
+        return self.page([{'Instances': [instance]} for instance in instances], 'Reservations', kwargs)
+
+    def describe_volumes(self, **kwargs):
+        self.call('DescribeVolumes')
+        volumes = self.select(self.volumes, kwargs.get('VolumeIds'), kwargs.get('Filters'),
+                              {'status': lambda volume: volume['State']})
+        return self.page(volumes, 'Volumes', kwargs)
+
+    def describe_spot_instance_requests(self, **kwargs):
+        self.call('DescribeSpotInstanceRequests')
+        request_ids = kwargs.get('SpotInstanceRequestIds')
+        with self.lock:
+            for request_id in request_ids or []:
+                request = self.requests[request_id]
+                if request['State'] == 'open':
+                    request['polls'] = request.get('polls', 0) + 1
+                    if request['polls'] >= self.fulfil_polls:
+                        self.fulfil(request)
+        requests = self.select(self.requests, request_ids, kwargs.get('Filters'), {})
+        internal = ('polls', 'zone', 'type')
+        return self.page([{key: value for key, value in request.items() if key not in internal}
+                          for request in requests], 'SpotInstanceRequests', kwargs)
+
+    def fulfil(self, request):
+        request['InstanceId'] = self.add_instance(request['zone'], self.now, request['type'],
+                                                  request['SpotInstanceRequestId'])
+        request.update(State='active', Status={'Code': 'fulfilled', 'Message': 'Your Spot request is fulfilled.'})
+
+    def request_spot_instances(self, **kwargs):
+        self.call('RequestSpotInstances')
+        specification = kwargs['LaunchSpecification']
+        tags = [tag for spec in kwargs.get('TagSpecifications', []) for tag in spec['Tags']]
+        requests = []
+        with self.lock:
+            if kwargs.get('ClientToken') in self.submissions:
+                return self.response(SpotInstanceRequests=list(self.submissions[kwargs['ClientToken']]))
+            for _ in range(kwargs.get('InstanceCount', 1)):
+                request_id = 'sir-{:08x}'.format(len(self.requests))
+                self.requests[request_id] = {
+                    'SpotInstanceRequestId': request_id, 'SpotPrice': kwargs['SpotPrice'], 'CreateTime': self.now,
+                    'State': 'open', 'Tags': tags, 'zone': specification['Placement']['AvailabilityZone'],
+                    'type': specification['InstanceType'],
+                    'Status': {'Code': 'pending-evaluation', 'Message': 'Your Spot request is pending evaluation.'}}
+                requests.append({'SpotInstanceRequestId': request_id, 'State': 'open'})
+            if kwargs.get('ClientToken'):
+                self.submissions[kwargs['ClientToken']] = requests
+        return self.response(SpotInstanceRequests=requests)
+
+    def create_tags(self, **kwargs):
+        self.call('CreateTags')
+        return self.response()
+
+    def terminate_instances(self, **kwargs):
+        self.call('TerminateInstances')
+        with self.lock:
+            for instance_id in kwargs['InstanceIds']:
+                self.instances[instance_id]['State'] = {'Name': 'terminated'}
+        return self.response(TerminatingInstances=[{'InstanceId': instance_id,
+                                                    'CurrentState': {'Name': 'shutting-down'}}
+                                                   for instance_id in kwargs['InstanceIds']])
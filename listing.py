@@ -0,0 +1,63 @@
+import sys
+import csv
+import json
+import heapq
+import tempfile
+
+OUTPUT_FORMATS = ('table', 'ndjson', 'csv')
+
+
+def spill(items):
+    """Write 'items' to a temporary file as JSON lines."""
+    file = tempfile.TemporaryFile('w+')
+    for item in items:
+        file.write(json.dumps(item) + '\n')
+    file.seek(0)
+    return file
+
+
+def read_spilled(file):
+    with file:
+        for line in file:
+            yield json.loads(line)
+
+
+def bounded_sort(items, key, chunk_size=10000):
+    """Sort JSON-serializable 'items' by 'key' holding at most 'chunk_size' of them in memory.
+
+    Sorted runs of 'chunk_size' items are spilled to temporary files and merged lazily.
+    """
+    runs, chunk = [], []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            runs.append(spill(sorted(chunk, key=key)))
+            chunk = []
+    if len(runs) == 0:
+        yield from sorted(chunk, key=key)
+        return
+    runs.append(spill(sorted(chunk, key=key)))
+    yield from heapq.merge(*[read_spilled(run) for run in runs], key=key)
+
+
+def write_rows(fields, header_format, row_format, rows, output='table', file=None):
+    """Write 'rows' as soon as they come in 'output' format: table, ndjson or csv.
+
+    Return the number of rows written.
+    """
+    file = file or sys.stdout
+    count = 0
+    if output == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(fields)
+    elif output == 'table':
+        print(header_format.format(*fields), file=file)
+    for row in rows:
+        if output == 'csv':
+            writer.writerow(row)
+        elif output == 'ndjson':
+            print(json.dumps(dict(zip(fields, row))), file=file)
+        else:
+            print(row_format.format(*row), file=file)
+        count += 1
+    return count
@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+
+TRACE_FORMATS = ('table', 'json', 'chrome')
+# Upper bounds in milliseconds of API call latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Timing:
+    """Count, total and max duration of a repeated piece of work."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def to_dict(self):
+        return {'count': self.count, 'seconds': self.seconds, 'max_seconds': self.max_seconds}
+
+
+class OperationStats(Timing):
+    """Statistics of calls of a single AWS API operation, retries included in their latency."""
+
+    def __init__(self):
+        super().__init__()
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.items = 0
+        self.bytes = 0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add_call(self, seconds, retries, throttles, items, size, failed):
+        self.add(seconds)
+        self.errors += failed
+        self.retries += retries
+        self.throttles += throttles
+        self.items += items
+        self.bytes += size
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds * 1000 <= bound),
+                      len(LATENCY_BUCKETS))
+        self.histogram[bucket] += 1
+
+    def get_percentile(self, q):
+        """Upper bound (ms) of the histogram bucket holding the 'q' quantile, None if unbounded."""
+        rank, total = q * self.count, 0
+        for bound, count in zip(LATENCY_BUCKETS + (None,), self.histogram):
+            total += count
+            if total >= rank:
+                return bound
+        return None
+
+    def to_dict(self):
+        return dict(super().to_dict(), errors=self.errors, retries=self.retries, throttles=self.throttles,
+                    items=self.items, bytes=self.bytes, buckets_ms=list(LATENCY_BUCKETS), histogram=self.histogram)
+
+
+def get_response_size(response):
+    """Return (items, bytes) of an API response: length of its result lists and of the HTTP body."""
+    items = sum(len(value) for value in response.values() if isinstance(value, list))
+    headers = response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    return items, int(headers.get('content-length', 0))
+
+
+class Metrics:
+    """Thread-safe recorder of AWS API calls and processing stages.
+
+    Aggregated statistics are available as a dict through 'snapshot'. If 'trace_events'
+    is set, every call and stage is also kept as a Chrome trace event.
+    """
+
+    def __init__(self, trace_events=False):
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.operations = {}
+        self.stages = {}
+        self.events = [] if trace_events else None
+
+    def keep_events(self):
+        """Start keeping trace events of calls and stages."""
+        with self.lock:
+            if self.events is None:
+                self.events = []
+
+    def add_event(self, category, name, start, seconds, args=None):
+        if self.events is None:
+            return
+        self.events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(),
+                            'tid': threading.get_ident(), 'ts': (start - self.origin) * 1e6,
+                            'dur': seconds * 1e6, 'args': args or {}})
+
+    def record_call(self, operation, start, retries=0, throttles=0, response=None, error=None):
+        """Record an API call started at 'start' ('time.perf_counter') that ended now."""
+        seconds = time.perf_counter() - start
+        items, size = get_response_size(response) if response else (0, 0)
+        with self.lock:
+            stats = self.operations.setdefault(operation, OperationStats())
+            stats.add_call(seconds, retries, throttles, items, size, error is not None)
+            self.add_event('api', operation, start, seconds,
+                           {'retries': retries, 'throttles': throttles, 'items': items, 'error': error})
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as a processing stage 'name'."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.stages.setdefault(name, Timing()).add(seconds)
+                self.add_event('stage', name, start, seconds)
+
+    def snapshot(self):
+        """Return a dict of per operation and per stage statistics."""
+        with self.lock:
+            return {'operations': {name: stats.to_dict() for name, stats in self.operations.items()},
+                    'stages': {name: timing.to_dict() for name, timing in self.stages.items()}}
+
+    def write_table(self, file):
+        fields = ['Operation', 'Calls', 'Errors', 'Retries', 'Throttles', 'Items', 'Bytes', 'Total(s)',
+                  'Mean(ms)', 'p50(ms)', 'p99(ms)', 'Max(ms)']
+        print('{:34}{:7}{:7}{:8}{:10}{:9}{:11}{:9}{:9}{:8}{:8}{:8}'.format(*fields), file=file)
+        with self.lock:
+            operations = sorted(self.operations.items(), key=lambda item: -item[1].seconds)
+            stages = sorted(self.stages.items(), key=lambda item: -item[1].seconds)
+            for name, stats in operations:
+                p50, p99 = ['<={}'.format(bound) if bound else '>{}'.format(LATENCY_BUCKETS[-1])
+                            for bound in (stats.get_percentile(0.5), stats.get_percentile(0.99))]
+                row = [name, stats.count, stats.errors, stats.retries, stats.throttles, stats.items, stats.bytes,
+                       stats.seconds, stats.seconds / stats.count * 1000, p50, p99, stats.max_seconds * 1000]
+                print('{:34}{:<7}{:<7}{:<8}{:<10}{:<9}{:<11}{:<9.3f}{:<9.1f}{:8}{:8}{:<8.1f}'.format(*row),
+                      file=file)
+            print('', file=file)
+            print('{:34}{:7}{:9}{:9}{:8}'.format('Stage', 'Count', 'Total(s)', 'Mean(ms)', 'Max(ms)'), file=file)
+            for name, timing in stages:
+                row = [name, timing.count, timing.seconds, timing.seconds / timing.count * 1000,
+                       timing.max_seconds * 1000]
+                print('{:34}{:<7}{:<9.3f}{:<9.1f}{:<8.1f}'.format(*row), file=file)
+
+    def write(self, trace_format, file=None):
+        """Write recorded metrics to 'file' (default: stderr) as a table, JSON or Chrome trace."""
+        file = file or sys.stderr
+        if trace_format == 'table':
+            self.write_table(file)
+        elif trace_format == 'json':
+            json.dump(self.snapshot(), file, indent=2)
+            print('', file=file)
+        else:
+            with self.lock:
+                json.dump({'traceEvents': list(self.events or []), 'displayTimeUnit': 'ms'}, file)
+
+
+# Process-wide recorder, used by 'aws_api.Client' unless given another one and by 'utils' analytics
+recorder = Metrics()
+
+
+def timed(name):
+    """Decorator recording every call of a function as stage 'name' of 'recorder'."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with recorder.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,193 @@
+import os
+import time
+import shutil
+import tempfile
+from collections import namedtuple
+from datetime import datetime
+
+import pytz
+import numpy as np
+
+
+# Columnar spot price history of a single zone: 'price' (float64) and 'timestamp'
+# (naive UTC datetime64[s]) arrays of equal length, sorted by timestamp
+PriceSeries = namedtuple('PriceSeries', ['price', 'timestamp'])
+
+
+def to_datetime64(dt):
+    """Convert a (possibly tz-aware) datetime to a naive UTC 'datetime64[s]'."""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(pytz.utc).replace(tzinfo=None)
+    return np.datetime64(dt, 's')
+
+
+def from_datetime64(ts):
+    """Convert a naive UTC 'datetime64' to a tz-aware datetime."""
+    return pytz.utc.localize(ts.astype('datetime64[s]').astype(datetime))
+
+
+def empty_series():
+    return PriceSeries(np.empty(0, np.float64), np.empty(0, 'datetime64[s]'))
+
+
+def sort_series(series):
+    """Sort records by timestamp keeping the last one of duplicate timestamps."""
+    order = np.argsort(series.timestamp, kind='stable')
+    price, timestamp = series.price[order], series.timestamp[order]
+    # The last record is always kept, built in place so empty series get an empty mask
+    unique = np.ones(timestamp.size, bool)
+    unique[:-1] = timestamp[1:] != timestamp[:-1]
+    return PriceSeries(price[unique], timestamp[unique])
+
+
+def concat_series(*series):
+    return PriceSeries(np.concatenate([s.price for s in series]),
+                       np.concatenate([s.timestamp for s in series]))
+
+
+def append_current_price(series, end_time):
+    """Set the last available price as current by repeating it at 'end_time'."""
+    if series.price.size == 0:
+        return series
+    return concat_series(series, PriceSeries(series.price[-1:], np.array([to_datetime64(end_time)])))
+
+
+def parse_price_page(page):
+    """Convert a 'describe_spot_price_history' page into typed (price, timestamp) arrays."""
+    records = page['SpotPriceHistory']
+    price = np.fromiter((float(i['SpotPrice']) for i in records), np.float64, len(records))
+    timestamp = np.fromiter((i['Timestamp'].timestamp() for i in records), np.float64, len(records))
+    return price, timestamp.astype(np.int64).astype('datetime64[s]')
+
+
+def slice_series(series, start_time):
+    """Return records since 'start_time' including the price in effect at 'start_time'."""
+    first = max(np.searchsorted(series.timestamp, start_time, side='right') - 1, 0)
+    return PriceSeries(series.price[first:], series.timestamp[first:])
+
+
+class SeriesBuffer:
+    """Growable typed price/timestamp buffer with amortised O(1) appends."""
+
+    def __init__(self, capacity=1024):
+        self.price = np.empty(capacity, np.float64)
+        self.timestamp = np.empty(capacity, 'datetime64[s]')
+        self.size = 0
+
+    def extend(self, price, timestamp):
+        end = self.size + len(price)
+        if end > self.price.size:
+            capacity = max(end, 2 * self.price.size)
+            for column in ('price', 'timestamp'):
+                data = getattr(self, column)
+                grown = np.empty(capacity, data.dtype)
+                grown[:self.size] = data[:self.size]
+                setattr(self, column, grown)
+        self.price[self.size:end] = price
+        self.timestamp[self.size:end] = timestamp
+        self.size = end
+
+    def to_series(self):
+        """Return buffered records as a sorted PriceSeries."""
+        return sort_series(PriceSeries(self.price[:self.size], self.timestamp[:self.size]))
+
+
+class PriceHistoryStore:
+    """Persistent incremental spot price history store.
+
+    Keeps one directory per (region, instance_type, product, zone) holding 'price' and
+    'timestamp' columns as '.npy' files, loaded memory-mapped, along with the time since
+    which the history is complete. Repeated queries only fetch records newer than the
+    last stored one.
+
+    Every save writes the columns into a new version directory and then switches the
+    'current' pointer file to it with a single rename, so concurrent readers always get
+    columns of the same version.
+    """
+
+    # Age after which versions and temporary files no longer current are removed
+    stale_seconds = 60
+
+    def __init__(self, store_dir, retention_days=90):
+        self.store_dir = os.path.expanduser(store_dir)
+        self.retention = np.timedelta64(retention_days, 'D')
+
+    def get_path(self, key):
+        region, instance_type, product, zone = key
+        return os.path.join(self.store_dir, region, instance_type,
+                            product.replace('/', '_').replace(' ', '_'), zone)
+
+    def load(self, key):
+        """Return memory-mapped PriceSeries and 'since' time of the stored history for 'key'."""
+        path = self.get_path(key)
+        try:
+            with open(os.path.join(path, 'current'), 'r') as file:
+                version = os.path.join(path, file.read())
+            price, timestamp = [np.load(os.path.join(version, column + '.npy'), mmap_mode='r')
+                                for column in ('price', 'timestamp')]
+            since = np.load(os.path.join(version, 'since.npy'))[()]
+        except (IOError, ValueError):
+            return empty_series(), None
+        return PriceSeries(price, timestamp), since
+
+    def save(self, key, series, since):
+        path = self.get_path(key)
+        os.makedirs(path, exist_ok=True)
+        version = tempfile.mkdtemp(prefix='v', dir=path)
+        for column, data in (('price', series.price), ('timestamp', series.timestamp), ('since', since)):
+            np.save(os.path.join(version, column + '.npy'), data)
+        try:
+            with open(os.path.join(path, 'current'), 'r') as file:
+                previous = file.read()
+        except IOError:
+            previous = None
+        fd, tmp_path = tempfile.mkstemp(dir=path)
+        with os.fdopen(fd, 'w') as file:
+            file.write(os.path.basename(version))
+        os.replace(tmp_path, os.path.join(path, 'current'))
+        self.prune(path, keep=('current', os.path.basename(version), previous))
+
+    def prune(self, path, keep):
+        """Remove stale entries of 'path' but 'keep', the previous version stays for readers still opening it."""
+        now = time.time()
+        for entry in os.scandir(path):
+            try:
+                if entry.name in keep or now - entry.stat().st_mtime < self.stale_seconds:
+                    continue
+                if entry.is_dir():
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+            except OSError:
+                # Removed by a concurrent run
+                pass
+
+    def compact(self, series, since, start_time):
+        """Sort and deduplicate records, dropping those older than the retention period.
+
+        The last record before the cutoff is kept as it holds the price in effect at the cutoff.
+        """
+        cutoff = min(np.datetime64('now', 's') - self.retention, start_time)
+        return slice_series(sort_series(series), cutoff), max(since, cutoff)
+
+    def get_price_series(self, key, start_time, fetch):
+        """Return the PriceSeries since 'start_time' backed by the memory-mapped store.
+
+        'fetch(start_time)' must return a PriceSeries of records newer than 'start_time';
+        it is called for the missing part of the history only.
+        """
+        start_time = to_datetime64(start_time)
+        series, since = self.load(key)
+
+        if since is None or since > start_time or series.timestamp.size == 0:
+            fetch_from, since = start_time, start_time
+        else:
+            fetch_from = series.timestamp[-1]
+
+        fetched = fetch(from_datetime64(fetch_from))
+        if fetched.timestamp.size > 0:
+            series, since = self.compact(concat_series(series, fetched), since, start_time)
+            self.save(key, series, since)
+            series, since = self.load(key)
+
+        return slice_series(series, start_time)
@@ -0,0 +1,70 @@
+import json
+from collections import namedtuple
+
+# A spot request to submit, 'line' is the index of the manifest entry it comes from
+Allocation = namedtuple('Allocation', ['line', 'profile', 'zone', 'price', 'count', 'valid_hours'])
+
+
+def read_manifest(file_path, profiles):
+    """Read and validate entries of a provisioning manifest.
+
+    The manifest is a JSON file with a 'requests' list. Every entry names a 'profile' of
+    'profiles' and may set 'count' (default: 1), 'zone' or a list of allowed 'zones',
+    a fixed 'price' or a 'max_price' capping the recommended bid, 'valid_hours' and
+    'max_per_zone' (default: 10) instances to request in a single zone.
+    """
+    with open(file_path, 'r') as file:
+        entries = json.load(file)['requests']
+    for line, entry in enumerate(entries):
+        if entry.get('profile') not in profiles:
+            raise ValueError('manifest entry {}: unknown profile {}'.format(line, entry.get('profile')))
+        if 'zone' in entry and 'zones' in entry:
+            raise ValueError("manifest entry {}: 'zone' and 'zones' are exclusive".format(line))
+        if 'price' in entry and 'max_price' in entry:
+            raise ValueError("manifest entry {}: 'price' and 'max_price' are exclusive".format(line))
+        if int(entry.get('count', 1)) < 1 or int(entry.get('max_per_zone', 10)) < 1:
+            raise ValueError("manifest entry {}: 'count' and 'max_per_zone' must be positive".format(line))
+    return entries
+
+
+def needs_recommendation(entry):
+    """Whether zone or price of manifest 'entry' comes from price history statistics."""
+    return not ('zone' in entry and 'price' in entry)
+
+
+def split_count(count, num_parts):
+    """Split 'count' into 'num_parts' near-equal parts, larger ones first."""
+    return [count // num_parts + (i < count % num_parts) for i in range(num_parts)]
+
+
+def plan_allocations(entries, zones_stats):
+    """Turn manifest 'entries' into a list of Allocation.
+
+    'zones_stats' maps profiles to 'stats.ZoneStats' lists of their zones. Every entry is
+    spread over as few of its least risky allowed zones as 'max_per_zone' permits, bidding
+    each zone's weighted bid unless 'price' is set. Zones bidding above 'max_price' are
+    skipped. Raise ValueError if an entry has no eligible zone or more instances than
+    'max_per_zone' in every eligible zone.
+    """
+    allocations = []
+    for line, entry in enumerate(entries):
+        count = int(entry.get('count', 1))
+        if not needs_recommendation(entry):
+            candidates = [(entry['zone'], float(entry['price']))]
+        else:
+            allowed = [entry['zone']] if 'zone' in entry else entry.get('zones')
+            max_price = float(entry.get('max_price', 'inf'))
+            ranked = sorted(zones_stats[entry['profile']], key=lambda zone_stats: zone_stats.risk)
+            candidates = [(zone_stats.zone, float(entry.get('price', zone_stats.weighted_bid)))
+                          for zone_stats in ranked if allowed is None or zone_stats.zone in allowed]
+            candidates = [(zone, price) for zone, price in candidates if price <= max_price]
+        if len(candidates) == 0:
+            raise ValueError('manifest entry {}: no zone satisfies the constraints'.format(line))
+        max_per_zone = int(entry.get('max_per_zone', 10))
+        if count > max_per_zone * len(candidates):
+            raise ValueError('manifest entry {}: count exceeds max_per_zone x eligible zones ({} x {})'.format(
+                line, max_per_zone, len(candidates)))
+        num_zones = -(-count // max_per_zone)
+        for (zone, price), zone_count in zip(candidates, split_count(count, num_zones)):
+            allocations.append(Allocation(line, entry['profile'], zone, price, zone_count, entry.get('valid_hours')))
+    return allocations
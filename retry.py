@@ -0,0 +1,96 @@
+import time
+import random
+import threading
+
+import botocore.exceptions
+
+
+# https://docs.aws.amazon.com/AWSEC2/latest/APIReference/errors-overview.html
+THROTTLING_CODES = {'RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'RequestThrottled',
+                    'TooManyRequestsException', 'SlowDown'}
+TRANSIENT_CODES = {'InternalError', 'InternalFailure', 'ServiceUnavailable', 'Unavailable',
+                   'RequestTimeout', 'RequestTimeoutException'}
+
+
+class APIError(Exception):
+    """AWS API call failed after all retry attempts."""
+
+    def __init__(self, operation, code, message):
+        super().__init__('{}: {}: {}'.format(operation, code, message))
+        self.operation = operation
+        self.code = code
+        self.message = message
+
+
+class ThrottlingError(APIError):
+    """AWS API call kept being throttled after all retry attempts."""
+
+
+class FatalAPIError(APIError):
+    """AWS API call failed with an error retrying would not fix."""
+
+
+def classify_error(err):
+    """Return (error class, code, message) of a boto3 call exception or non-200 response."""
+    if isinstance(err, botocore.exceptions.ClientError):
+        error = err.response.get('Error', {})
+        code, message = error.get('Code', 'Unknown'), error.get('Message', str(err))
+        if code in THROTTLING_CODES:
+            return ThrottlingError, code, message
+        # Resources may not be visible yet right after creation (eventual consistency)
+        if code in TRANSIENT_CODES or code.endswith('.NotFound'):
+            return APIError, code, message
+        return FatalAPIError, code, message
+    if isinstance(err, (botocore.exceptions.ConnectionError, botocore.exceptions.ReadTimeoutError, TimeoutError)):
+        return APIError, type(err).__name__, str(err)
+    if isinstance(err, dict):
+        return APIError, 'HTTPStatusCode', err['ResponseMetadata']['HTTPStatusCode']
+    return FatalAPIError, type(err).__name__, str(err)
+
+
+def get_backoff(attempt, base, cap):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RateLimiter:
+    """Thread-safe token bucket limiting API calls per second.
+
+    The rate adapts to throttling: it is halved when calls get throttled (at most once
+    per second, as concurrent calls are usually throttled together) and grows back
+    linearly with every successful call up to 'max_rate'.
+    """
+
+    def __init__(self, max_rate=20, burst=None, min_rate=0.5):
+        self.max_rate = self.rate = float(max_rate)
+        self.min_rate = min_rate
+        self.capacity = float(burst or max_rate)
+        self.tokens = self.capacity
+        self.timestamp = self.throttled_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return seconds to wait until it is refilled before calling."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def acquire(self):
+        """Block until a call is allowed."""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.throttled_at >= 1:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.throttled_at = now
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 1000)
@@ -0,0 +1,163 @@
+from collections import namedtuple
+
+import numpy as np
+
+
+class ZoneStats(namedtuple('ZoneStats', ['zone', 'price', 'timestamp', 'current', 'min', 'max', 'mean',
+                                         'std', 'p99', 'three_sigma', 'weighted_bid'])):
+    """Spot price statistics of a single availability zone.
+
+    'price' and 'timestamp' hold the price series all the statistics are computed from.
+    """
+
+    @property
+    def risk(self):
+        """Price level a bid has to exceed to survive almost all price spikes."""
+        return max(self.three_sigma, self.p99)
+
+
+# Zones price history aligned on a uniform time grid: 'price' is a (zones x time) matrix
+PriceMatrix = namedtuple('PriceMatrix', ['zones', 'timestamp', 'price'])
+
+
+def hourly_max(series):
+    """Aggregate 'price_store.PriceSeries' into (price, timestamp) arrays of hourly max prices."""
+    hours = series.timestamp.astype('datetime64[h]')
+    order = np.argsort(hours, kind='stable')
+    hours, price = hours[order], series.price[order]
+    if hours.size == 0:
+        return price, hours
+    starts = np.flatnonzero(np.append(True, hours[1:] != hours[:-1]))
+    return np.maximum.reduceat(price, starts), hours[starts]
+
+
+def get_weighted_bids(price_mat):
+    """Pick a bid per row of 'price_mat' among the top 1% of prices weighted towards the most recent ones."""
+    n = price_mat.shape[1]
+    base = np.arange(n, dtype=np.float64) / n
+    weights = np.tanh((base - 0.7) / 0.2)
+    weights = (weights - np.min(weights)) / (np.max(weights) - np.min(weights)) + 1
+    weights /= np.sum(weights)
+
+    weighted = np.multiply(weights, price_mat)
+    # 99th percentile using 'nearest' interpolation
+    threshold = np.sort(weighted, axis=1)[:, int(np.around(0.99 * (n - 1)))]
+
+    return np.max(np.where(weighted >= threshold[:, np.newaxis], price_mat, -np.inf), axis=1)
+
+
+def get_weighted_bid(price_arr):
+    return get_weighted_bids(price_arr[np.newaxis])[0]
+
+
+def get_zone_stats(zone, series):
+    price_arr, timestamp_arr = hourly_max(series)
+    mean, std = np.mean(price_arr), np.std(price_arr)
+    return ZoneStats(zone=zone,
+                     price=price_arr,
+                     timestamp=timestamp_arr,
+                     current=price_arr[-1],
+                     min=np.min(price_arr),
+                     max=np.max(price_arr),
+                     mean=mean,
+                     std=std,
+                     p99=np.percentile(price_arr, 99),
+                     three_sigma=mean + (3 * std),
+                     weighted_bid=get_weighted_bid(price_arr))
+
+
+def get_price_matrix(price_history, resolution):
+    """Align zones price history on a uniform time grid with 'resolution' step.
+
+    Prices are forward filled as a step function into a (zones x time) matrix. The grid
+    spans from the moment every zone has a known price to the latest record of any zone.
+    Zones without any price records are skipped.
+    """
+    zones = [zone for zone, series in price_history.items() if series.price.size > 0]
+    if len(zones) == 0:
+        return PriceMatrix(zones, np.empty(0, 'datetime64[s]'), np.empty((0, 0)))
+    start = max(price_history[zone].timestamp[0] for zone in zones)
+    end = max(price_history[zone].timestamp[-1] for zone in zones)
+    timestamp = np.arange(start, max(end, start + resolution), resolution).astype('datetime64[s]')
+    price = np.stack([price_history[zone].price[
+        np.searchsorted(price_history[zone].timestamp, timestamp, side='right') - 1] for zone in zones])
+    return PriceMatrix(zones, timestamp, price)
+
+
+def get_aligned_zones_stats(price_history, resolution):
+    """Compute time-weighted ZoneStats of all zones at once over an aligned price matrix."""
+    matrix = get_price_matrix(price_history, resolution)
+    price = matrix.price
+    mean, std = np.mean(price, axis=1), np.std(price, axis=1)
+    columns = {'current': np.array([price_history[zone].price[-1] for zone in matrix.zones]),
+               'min': np.min(price, axis=1),
+               'max': np.max(price, axis=1),
+               'mean': mean,
+               'std': std,
+               'p99': np.percentile(price, 99, axis=1),
+               'three_sigma': mean + (3 * std),
+               'weighted_bid': get_weighted_bids(price)}
+    return [ZoneStats(zone=zone, price=price[i], timestamp=matrix.timestamp,
+                      **{name: column[i] for name, column in columns.items()})
+            for i, zone in enumerate(matrix.zones)]
+
+
+def get_zones_stats(price_history, resolution=None):
+    """Compute ZoneStats of every zone in 'price_history' keeping the zones order.
+
+    By default statistics are computed over hourly max prices, so every hour with a price
+    change weighs the same. If 'resolution' (minutes or np.timedelta64) is given, they are
+    time-weighted over a price matrix aligned on a uniform grid of that step instead.
+    Zones without any price records are skipped.
+    """
+    if resolution:
+        return get_aligned_zones_stats(price_history, np.timedelta64(resolution, 'm'))
+    return [get_zone_stats(zone, series) for zone, series in price_history.items() if series.price.size > 0]
+
+
+def downsample_minmax(timestamp, price, max_points):
+    """Keep the lowest and highest price of each of 'max_points' / 2 equal-count buckets.
+
+    Return (timestamp, price) arrays of at most 'max_points' points in time order, spikes
+    and dips are kept as is.
+    """
+    if price.size <= max_points:
+        return timestamp, price
+    edges = np.linspace(0, price.size, max(max_points // 2, 1) + 1).astype(np.int64)
+    index = np.unique(np.concatenate([[start + np.argmin(price[start:end]), start + np.argmax(price[start:end])]
+                                      for start, end in zip(edges[:-1], edges[1:])]))
+    return timestamp[index], price[index]
+
+
+def downsample_lttb(timestamp, price, max_points):
+    """Largest-Triangle-Three-Buckets downsampling to at most 'max_points' points.
+
+    Keep the first and last points and from every bucket in between the point forming the
+    largest triangle with the point kept from the previous bucket and the next bucket average.
+    """
+    if price.size <= max_points or max_points < 3:
+        return timestamp, price
+    x = timestamp.astype('datetime64[s]').astype(np.float64)
+    edges = np.linspace(1, price.size - 1, max_points - 1).astype(np.int64)
+    # Averages of every bucket, the last point stands for the bucket after the last one
+    counts = np.diff(edges)
+    avg_x = np.append(np.add.reduceat(x[:-1], edges[:-1]) / counts, x[-1])
+    avg_y = np.append(np.add.reduceat(price[:-1], edges[:-1]) / counts, price[-1])
+
+    index = np.empty(max_points, np.int64)
+    index[0], index[-1] = 0, price.size - 1
+    for i, (start, end) in enumerate(zip(edges[:-1], edges[1:])):
+        a = index[i]
+        area = np.abs((x[a] - avg_x[i + 1]) * (price[start:end] - price[a]) -
+                      (x[a] - x[start:end]) * (avg_y[i + 1] - price[a]))
+        index[i + 1] = start + np.argmax(area)
+    return timestamp[index], price[index]
+
+
+DOWNSAMPLING = {'lttb': downsample_lttb, 'minmax': downsample_minmax}
+
+
+def recommend(zones_stats):
+    """Return (zone, price) of the least risky zone and its weighted bid."""
+    best = min(zones_stats, key=lambda stats: stats.risk)
+    return best.zone, best.weighted_bid
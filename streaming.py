@@ -0,0 +1,249 @@
+import math
+import bisect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import stats
+import price_store
+
+
+class RunningMoments:
+    """Mean and population variance of values added and removed one at a time (Welford)."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def remove(self, value):
+        if self.count <= 1:
+            self.__init__()
+            return
+        self.count -= 1
+        delta = value - self.mean
+        self.mean -= delta / self.count
+        self.m2 = max(self.m2 - delta * (value - self.mean), 0.0)
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / self.count) if self.count > 0 else 0.0
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch of positive values with 'relative_accuracy' (DDSketch).
+
+    Values are counted in logarithmic buckets, so adding, removing and merging sketches are
+    exact on counts and any quantile is within 'relative_accuracy' of an actual value.
+    """
+
+    def __init__(self, relative_accuracy=0.005):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.count = 0
+
+    def get_key(self, value):
+        return math.ceil(math.log(max(value, 1e-9)) / self.log_gamma)
+
+    def add(self, value, count=1):
+        key = self.get_key(value)
+        total = self.buckets.get(key, 0) + count
+        if total > 0:
+            self.buckets[key] = total
+        else:
+            del self.buckets[key]
+        self.count += count
+
+    def remove(self, value):
+        self.add(value, -1)
+
+    def merge(self, other):
+        """Add all the values counted by sketch 'other' of the same accuracy."""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('cannot merge sketches of different accuracy')
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.count += other.count
+
+    def quantile(self, q):
+        """Return the 'q' quantile using 'nearest' rank, NaN if the sketch is empty."""
+        rank, total = int(np.around(q * (self.count - 1))), 0
+        for key in sorted(self.buckets):
+            total += self.buckets[key]
+            if total > rank:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return math.nan
+
+
+class RecencyRank:
+    """Prices ordered by their weight decaying by half every 'half_life' hours.
+
+    Decay scales all the weighted prices alike as time passes, so the order of a price is
+    fixed when it is added: a sorted list of log weighted prices is maintained with bisect.
+    """
+
+    def __init__(self, half_life):
+        self.rate = math.log(2) / half_life
+        self.ranked = []
+
+    def get_item(self, hour, price):
+        return math.log(max(price, 1e-9)) + hour * self.rate, hour, price
+
+    def add(self, hour, price):
+        bisect.insort(self.ranked, self.get_item(hour, price))
+
+    def remove(self, hour, price):
+        del self.ranked[bisect.bisect_left(self.ranked, self.get_item(hour, price))]
+
+    def get_bid(self, q=0.99):
+        """Highest price among the weighted prices above their 'q' quantile, like 'stats.get_weighted_bids'."""
+        if len(self.ranked) == 0:
+            return math.nan
+        threshold = int(np.around(q * (len(self.ranked) - 1)))
+        return max(price for _, _, price in self.ranked[threshold:])
+
+
+def to_hour(timestamp):
+    return int(np.datetime64(timestamp, 'h').astype(np.int64))
+
+
+class ZoneStream:
+    """Running spot price statistics of a zone over a sliding window of hourly max prices.
+
+    As in 'stats.get_zone_stats' every hour having price records weighs the same, but a new
+    record costs O(log n) in the number of hours of the window instead of a pass over the
+    whole history. Min and max are exact, p99 comes from a QuantileSketch and the weighted
+    bid from a RecencyRank decaying by half every 'half_life' hours (default: the window).
+    """
+
+    def __init__(self, zone, window_hours, half_life=None, relative_accuracy=0.005):
+        self.zone = zone
+        self.window_hours = window_hours
+        # (hour, max price) of the window in time order, the last hour is still open
+        self.hours = deque()
+        self.moments = RunningMoments()
+        self.sketch = QuantileSketch(relative_accuracy)
+        self.rank = RecencyRank(half_life or window_hours)
+        # Monotonic queues of (hour, price) whose first items are the max of the window and
+        # the min of its closed hours, the max price of the open hour can only rise
+        self.min_queue, self.max_queue = deque(), deque()
+        self.current = None
+        self.last_timestamp = None
+
+    def add_value(self, hour, price):
+        self.moments.add(price)
+        self.sketch.add(price)
+        self.rank.add(hour, price)
+        while len(self.max_queue) > 0 and self.max_queue[-1][1] <= price:
+            self.max_queue.pop()
+        self.max_queue.append((hour, price))
+
+    def remove_value(self, hour, price):
+        self.moments.remove(price)
+        self.sketch.remove(price)
+        self.rank.remove(hour, price)
+
+    def set_hour_price(self, hour, price):
+        """Account 'price' in effect during 'hour', records of closed hours count in the open one."""
+        if len(self.hours) > 0:
+            last_hour, last_price = self.hours[-1]
+            if hour <= last_hour:
+                if price > last_price:
+                    self.remove_value(last_hour, last_price)
+                    self.hours[-1] = (last_hour, price)
+                    self.add_value(last_hour, price)
+                return
+            # The last hour closes, its max price is final
+            while len(self.min_queue) > 0 and self.min_queue[-1][1] >= last_price:
+                self.min_queue.pop()
+            self.min_queue.append((last_hour, last_price))
+        self.hours.append((hour, price))
+        self.add_value(hour, price)
+
+    def ingest(self, series):
+        """Add records of 'price_store.PriceSeries' newer than those ingested so far, return their number."""
+        if self.last_timestamp is not None:
+            newer = series.timestamp > self.last_timestamp
+            series = price_store.PriceSeries(series.price[newer], series.timestamp[newer])
+        if series.price.size == 0:
+            return 0
+        price, hours = stats.hourly_max(series)
+        for hour, hour_price in zip(hours.astype(np.int64).tolist(), price.tolist()):
+            self.set_hour_price(hour, hour_price)
+        self.current, self.last_timestamp = float(series.price[-1]), series.timestamp[-1]
+        return series.price.size
+
+    def advance(self, now):
+        """Slide the window to end at 'now' ('datetime64'), the current price holding until then."""
+        if self.current is None:
+            return
+        self.set_hour_price(to_hour(now), self.current)
+        start = to_hour(now - np.timedelta64(self.window_hours, 'h'))
+        while self.hours[0][0] < start:
+            hour, price = self.hours.popleft()
+            self.remove_value(hour, price)
+            for queue in (self.min_queue, self.max_queue):
+                if len(queue) > 0 and queue[0][0] == hour:
+                    queue.popleft()
+
+    def get_stats(self):
+        """Return 'stats.ZoneStats' of the window."""
+        mean, std = self.moments.mean, self.moments.std
+        last_price = self.hours[-1][1]
+        return stats.ZoneStats(zone=self.zone,
+                               price=np.array([price for _, price in self.hours]),
+                               timestamp=np.array([hour for hour, _ in self.hours], 'datetime64[h]'),
+                               current=last_price,
+                               min=min(self.min_queue[0][1], last_price) if len(self.min_queue) > 0 else last_price,
+                               max=self.max_queue[0][1],
+                               mean=mean,
+                               std=std,
+                               p99=self.sketch.quantile(0.99),
+                               three_sigma=mean + (3 * std),
+                               weighted_bid=self.rank.get_bid())
+
+
+class StreamingRecommender:
+    """Keep spot price statistics of a profile current from new price records only.
+
+    The first 'poll' loads 'days' of price history of 'availability_zones' through 'client'
+    (from its price store if set), the next ones only fetch records since the previous poll
+    and update a ZoneStream per zone.
+    """
+
+    def __init__(self, client, profile, availability_zones, days=7, half_life=None):
+        self.client = client
+        self.profile = profile
+        self.days = days
+        self.streams = {zone: ZoneStream(zone, days * 24, half_life) for zone in availability_zones}
+
+    def fetch(self, zone, kwargs):
+        stream = self.streams[zone]
+        # Only published records are ingested, the current price is carried to 'EndTime' by
+        # 'ZoneStream.advance', so records published late are still newer than the last one
+        if stream.last_timestamp is None:
+            return self.client.get_zone_price_records(zone, kwargs)
+        start_time = price_store.from_datetime64(stream.last_timestamp)
+        return self.client.fetch_zone_price_history(zone, dict(kwargs, StartTime=start_time))
+
+    def poll(self):
+        """Ingest new price records of every zone, return 'stats.ZoneStats' of zones having any."""
+        kwargs = self.client.get_price_history_kwargs(self.profile, self.days)
+        now = price_store.to_datetime64(kwargs['EndTime'])
+        with self.client.metrics.stage('streaming_poll'):
+            max_workers = max(1, min(self.client.max_workers, len(self.streams)))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                fetched = executor.map(lambda zone: self.fetch(zone, kwargs), list(self.streams))
+                for stream, series in zip(self.streams.values(), fetched):
+                    stream.ingest(series)
+                    stream.advance(now)
+        return [stream.get_stats() for stream in self.streams.values() if stream.current is not None]
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import utils  # noqa: E402
+import aws_api  # noqa: E402
+import fake_ec2  # noqa: E402
+
+
+@pytest.fixture
+def config():
+    return utils.read_config(os.path.join(ROOT, 'config.json'))
+
+
+@pytest.fixture
+def fake(config):
+    return fake_ec2.FakeEC2(config['user_profile']['tags'], num_zones=2, days=10, num_instances=10, num_volumes=20)
+
+
+@pytest.fixture
+def client(config, fake):
+    client = aws_api.Client(config, rate_limit=1e9, backoff_base=0.01, backoff_max=0.01)
+    client.ec2 = fake
+    return client
+
+
+@pytest.fixture
+def profile(config):
+    return next(iter(config['instance_profiles']))
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+import utils
+import backtest
+from price_store import PriceSeries
+
+
+def get_series(prices, hours):
+    start = np.datetime64('2024-01-01T00:00:00')
+    return PriceSeries(np.array(prices), start + np.array(hours, 'timedelta64[h]').astype('timedelta64[s]'))
+
+
+def test_backtest_zone_step_function():
+    # 0.2 for 1h, 0.5 for 2h, 0.2 for 1h, then the current price 0.3
+    series = get_series([0.2, 0.5, 0.2, 0.3], [0, 1, 3, 4])
+    run_fraction, interruptions, mean_run_hours, cost = backtest.backtest_zone(series, np.array([0.1, 0.2, 0.5]))
+
+    assert run_fraction.tolist() == [0, 0.5, 1]
+    assert interruptions.tolist() == [0, 2, 0]
+    assert mean_run_hours.tolist() == [0, 1, 4]
+    assert cost.tolist() == pytest.approx([0, 0.4, 1.4])
+
+
+def test_backtest_bids_skips_short_zones():
+    price_history = {'b': get_series([0.2, 0.5, 0.2, 0.3], [0, 1, 3, 4]), 'a': get_series([0.2], [0])}
+    result = backtest.backtest_bids(price_history, [0.2, 0.5])
+    assert result.zones == ['b']
+    assert result.run_fraction.shape == result.cost.shape == (1, 2)
+    assert backtest.get_cheapest_bids(result) == [('b', 1)]
+
+
+def test_backtest_bids_without_history(capsys):
+    price_history = {'a': get_series([0.2], [0])}
+    result = backtest.backtest_bids(price_history, backtest.get_bid_grid(price_history, 10))
+    assert result.zones == [] and result.run_fraction.shape == (0, 10)
+    assert backtest.get_cheapest_bids(result) == []
+    utils.print_backtest(result)
+    assert capsys.readouterr().out == 'No price history to backtest\n'
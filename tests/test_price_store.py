@@ -0,0 +1,69 @@
+from datetime import timedelta
+
+import numpy as np
+
+import price_store
+from price_store import PriceSeries
+
+
+def get_kwargs(client, profile, end_time, days=7):
+    return dict(client.get_price_history_kwargs(profile, days), StartTime=end_time - timedelta(days=days),
+                EndTime=end_time)
+
+
+def test_sort_series_empty():
+    series = price_store.sort_series(price_store.empty_series())
+    assert series.price.size == 0 and series.timestamp.size == 0
+
+
+def test_sort_series_keeps_last_duplicate():
+    timestamp = np.array([3, 1, 3, 2], 'datetime64[s]')
+    series = price_store.sort_series(PriceSeries(np.array([0.1, 0.2, 0.3, 0.4]), timestamp))
+    assert series.price.tolist() == [0.2, 0.4, 0.3]
+    assert series.timestamp.tolist() == np.array([1, 2, 3], 'datetime64[s]').tolist()
+
+
+def test_store_load_missing(tmp_path):
+    series, since = price_store.PriceHistoryStore(str(tmp_path)).load(('r', 't', 'p', 'z'))
+    assert series.price.size == 0 and since is None
+
+
+def test_store_save_load_versions(tmp_path):
+    store = price_store.PriceHistoryStore(str(tmp_path))
+    key = ('us-east-1', 'g2.2xlarge', 'Linux/UNIX', 'us-east-1a')
+    first = PriceSeries(np.array([0.1, 0.2]), np.array([10, 20], 'datetime64[s]'))
+    second = PriceSeries(np.array([0.1, 0.2, 0.3]), np.array([10, 20, 30], 'datetime64[s]'))
+
+    store.save(key, first, np.datetime64(10, 's'))
+    loaded, since = store.load(key)
+    store.save(key, second, np.datetime64(5, 's'))
+
+    # A reader of the previous version still sees consistent columns
+    assert loaded.price.tolist() == [0.1, 0.2] and loaded.timestamp.size == 2
+    assert since == np.datetime64(10, 's')
+    loaded, since = store.load(key)
+    assert loaded.price.tolist() == [0.1, 0.2, 0.3] and loaded.timestamp.size == 3
+    assert since == np.datetime64(5, 's')
+
+
+def test_incremental_fetch_matches_full_fetch(tmp_path, monkeypatch, client, fake, profile):
+    zone = fake.zones[0]
+    end_time = fake.now
+    client.price_store = price_store.PriceHistoryStore(str(tmp_path))
+    stored = client.get_zone_price_records(zone, get_kwargs(client, profile, end_time - timedelta(days=2)))
+
+    start_times = []
+    describe = fake.describe_spot_price_history
+    monkeypatch.setattr(fake, 'describe_spot_price_history',
+                        lambda **kwargs: start_times.append(kwargs['StartTime']) or describe(**kwargs))
+    kwargs = get_kwargs(client, profile, end_time)
+    incremental = client.get_zone_price_records(zone, kwargs)
+    # Only records newer than the stored ones are fetched
+    assert {price_store.to_datetime64(start_time) for start_time in start_times} == {stored.timestamp[-1]}
+
+    client.price_store = None
+    full = client.get_zone_price_records(zone, kwargs)
+    # The store also keeps the price in effect at 'StartTime'
+    start = np.searchsorted(incremental.timestamp, price_store.to_datetime64(kwargs['StartTime']))
+    assert np.array_equal(incremental.price[start:], full.price)
+    assert np.array_equal(incremental.timestamp[start:], full.timestamp)
@@ -0,0 +1,53 @@
+import time
+import asyncio
+import threading
+
+import botocore.exceptions
+
+import async_api
+
+
+def test_timed_out_submission_retried_once(monkeypatch, client, fake, profile):
+    submit, submitted = fake.request_spot_instances, []
+
+    def request_spot_instances(**kwargs):
+        submitted.append(kwargs['ClientToken'])
+        response = submit(**kwargs)
+        if len(submitted) == 1:
+            # The request reached AWS but its response got lost
+            raise botocore.exceptions.ReadTimeoutError(endpoint_url='https://ec2.amazonaws.com')
+        return response
+
+    monkeypatch.setattr(fake, 'request_spot_instances', request_spot_instances)
+    num_requests = len(fake.requests)
+    requests = client.request_spot_instances(profile, fake.zones[0], 0.5, 3)
+
+    assert len(submitted) == 2 and len(set(submitted)) == 1
+    assert len(fake.requests) - num_requests == 3
+    assert len(requests) == 3 and all(request['State'] == 'active' for request in requests)
+
+
+def test_async_timed_out_submission_retried_once(monkeypatch, client, fake, profile):
+    submit, first = fake.request_spot_instances, threading.Event()
+
+    def request_spot_instances(**kwargs):
+        # The first attempt outlives 'call_timeout' and completes after the retry
+        if not first.is_set():
+            first.set()
+            time.sleep(0.3)
+        return submit(**kwargs)
+
+    monkeypatch.setattr(fake, 'request_spot_instances', request_spot_instances)
+    num_requests = len(fake.requests)
+
+    async def request():
+        async with async_api.AsyncClient(client=client, call_timeout=0.1) as async_client:
+            requests = await async_client.request_spot_instances(profile, fake.zones[0], 0.5, 2)
+            # Let the timed out attempt finish in its thread
+            await asyncio.sleep(0.4)
+            return requests
+
+    requests = asyncio.run(request())
+    assert fake.calls['RequestSpotInstances'] == 2
+    assert len(fake.requests) - num_requests == 2
+    assert len(requests) == 2
@@ -0,0 +1,60 @@
+from datetime import timedelta
+
+import numpy as np
+import pytest
+
+import stats
+import streaming
+import price_store
+
+
+def test_zone_stream_matches_zone_stats(client, fake, profile):
+    zone = fake.zones[0]
+    kwargs = dict(client.get_price_history_kwargs(profile, 3), StartTime=fake.now - timedelta(days=3),
+                  EndTime=fake.now)
+    series = client.fetch_zone_price_history(zone, kwargs)
+
+    stream = streaming.ZoneStream(zone, 7 * 24)
+    assert stream.ingest(series) == series.price.size
+    stream.advance(price_store.to_datetime64(fake.now))
+    streamed = stream.get_stats()
+    batch = stats.get_zone_stats(zone, price_store.append_current_price(series, fake.now))
+
+    assert np.array_equal(streamed.price, batch.price)
+    assert [streamed.current, streamed.min, streamed.max] == [batch.current, batch.min, batch.max]
+    assert streamed.mean == pytest.approx(batch.mean) and streamed.std == pytest.approx(batch.std)
+    assert streamed.p99 == pytest.approx(np.percentile(batch.price, 99, method='nearest'), rel=0.005)
+
+
+def test_zone_stream_ingests_new_records_only(client, fake, profile):
+    zone = fake.zones[0]
+    kwargs = dict(client.get_price_history_kwargs(profile, 1), StartTime=fake.now - timedelta(days=1),
+                  EndTime=fake.now)
+    series = client.fetch_zone_price_history(zone, kwargs)
+    stream = streaming.ZoneStream(zone, 24)
+    stream.ingest(price_store.PriceSeries(series.price[:-5], series.timestamp[:-5]))
+    assert stream.ingest(series) == 5
+    assert stream.ingest(series) == 0
+    assert stream.current == series.price[-1]
+
+
+def test_zone_stream_window_slides():
+    stream = streaming.ZoneStream('z', 2)
+    start = np.datetime64('2024-01-01T00:00:00')
+    stream.ingest(price_store.PriceSeries(np.array([0.9, 0.2, 0.4]),
+                                          start + np.array([0, 3600, 7200], 'timedelta64[s]')))
+    stream.advance(start + np.timedelta64(3, 'h'))
+    # The first hour at 0.9 left the window
+    assert [price for _, price in stream.hours] == [0.2, 0.4, 0.4]
+    zone_stats = stream.get_stats()
+    assert (zone_stats.min, zone_stats.max, zone_stats.current) == (0.2, 0.4, 0.4)
+
+
+def test_poll_reaches_latest_records(client, fake, profile):
+    # Records are published up to the current time whatever the display time zone
+    recommender = streaming.StreamingRecommender(client, profile, fake.zones, 1)
+    zones_stats = recommender.poll()
+    for zone, zone_stats in zip(fake.zones, zones_stats):
+        price, timestamp = fake.price_history[zone]
+        assert recommender.streams[zone].last_timestamp == np.datetime64(int(timestamp[0]), 's')
+        assert zone_stats.current == price[0]
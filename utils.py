@@ -1,12 +1,10 @@
+import os
 import argparse
 import json
 from collections import OrderedDict
-from datetime import datetime
 
-import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.dates import DateFormatter, DayLocator, HourLocator
-from matplotlib import mlab
+import listing
+import metrics
 
 
 # https://bugs.python.org/issue25297
@@ -42,16 +40,48 @@ def get_argparser():
                                      description='Simple AWS EC2 Spot Instance manager')
     parser.add_argument('--configPath', default='config.json', metavar='FILEPATH',
                         help='path to the config file (default: %(default)s)')
+    parser.add_argument('--maxWorkers', default=8, type=int, metavar='N',
+                        help='max number of concurrent AWS API requests (default: %(default)s)')
+    parser.add_argument('--resolution', type=int, metavar='MINUTES',
+                        help='compute time-weighted price statistics on a grid of this step (default: hourly max)')
+    parser.add_argument('--storeDir', default='~/.aws_agent/price_history', metavar='DIRPATH',
+                        help='path to the local price history store (default: %(default)s)')
+    parser.add_argument('--noStore', action='store_true',
+                        help='always download full price history, bypassing the local store')
+    parser.add_argument('--cacheDir', default='~/.aws_agent/cache', metavar='DIRPATH',
+                        help='path to the API lookups cache shared across runs (default: %(default)s)')
+    parser.add_argument('--noCache', action='store_true',
+                        help='do not share cached API lookups (e.g. availability zones) across runs')
+    parser.add_argument('--trace', choices=metrics.TRACE_FORMATS,
+                        help='report API calls and processing stages timing on exit')
+    parser.add_argument('--traceFile', metavar='FILEPATH',
+                        help='write the --trace report to a file (default: stderr)')
+    parser.add_argument('--socketPath', default='~/.aws_agent/agent.sock', metavar='FILEPATH',
+                        help='path to the agent daemon socket (default: %(default)s)')
+    parser.add_argument('--noDaemon', action='store_true',
+                        help='query AWS directly even if the agent daemon is running')
 
     # Agent's commands section
     subparsers = parser.add_subparsers(dest='subparser_name', metavar="", title='commands')
 
     subparsers.add_parser('listProfiles', formatter_class=Formatter, help='show instance profiles')
 
+    daemon = subparsers.add_parser('daemon', formatter_class=Formatter,
+                                   help='run resident agent serving other commands from a live inventory')
+    daemon.add_argument('--refresh', default=60, type=int, metavar='SECONDS',
+                        help='inventory refresh interval (default: %(default)s)')
+
     subparsers.add_parser('listAvailabilityZones', formatter_class=Formatter,
                           help='show availability zones in a current region')
 
-    subparsers.add_parser('listVolumes', formatter_class=Formatter,
+    # Common options of resources listing commands
+    listing_parser = argparse.ArgumentParser(add_help=False)
+    listing_parser.add_argument('--output', default='table', choices=listing.OUTPUT_FORMATS,
+                                help='output format (default: %(default)s)')
+    listing_parser.add_argument('--noSort', action='store_true',
+                                help='print rows as they arrive instead of sorting them by time')
+
+    subparsers.add_parser('listVolumes', formatter_class=Formatter, parents=[listing_parser],
                           help='show block device volumes')
 
     subparsers.add_parser('attachVolume', formatter_class=Formatter,
@@ -67,30 +97,124 @@ def get_argparser():
     subparsers.add_parser('printPriceHistory', formatter_class=Formatter,
                           help='print price history statistics')
 
-    subparsers.add_parser('plotPriceHistory', formatter_class=Formatter,
-                          help='plot price history statistics')
+    # Common options of price history plotting commands
+    plot_parser = argparse.ArgumentParser(add_help=False)
+    plot_parser.add_argument('--maxPoints', default=1000, type=int, metavar='N',
+                             help='max number of points drawn per zone (default: %(default)s)')
+    plot_parser.add_argument('--downsample', default='lttb', choices=['lttb', 'minmax'],
+                             help='curves downsampling method (default: %(default)s)')
+
+    plot_price_history = subparsers.add_parser('plotPriceHistory', formatter_class=Formatter, parents=[plot_parser],
+                                               help='plot price history statistics')
+    plot_price_history.add_argument('--output', metavar='FILEPATH',
+                                    help='save the plot to an image file (e.g. .png, .svg) instead of showing it')
+
+    render_price_history = subparsers.add_parser(
+        'renderPriceHistory', formatter_class=Formatter, parents=[plot_parser],
+        help='render price history plots of many profiles and regions to image files')
+    render_price_history.add_argument('--profiles', nargs='+', metavar='PROFILE',
+                                      help='names of instance profiles (default: all)')
+    render_price_history.add_argument('--regions', nargs='+', metavar='REGION',
+                                      help='regions to query (default: current region)')
+    render_price_history.add_argument('--days', default=7, type=int,
+                                      help='period in days to plot (default: %(default)s)')
+    render_price_history.add_argument('--outputDir', default='.', metavar='DIRPATH',
+                                      help='directory to save PROFILE_REGION images to (default: %(default)s)')
+    render_price_history.add_argument('--format', default='png', choices=['png', 'svg', 'pdf'],
+                                      help='image format (default: %(default)s)')
+    render_price_history.add_argument('--histogram', action='store_true', help='render price histograms too')
+    render_price_history.add_argument('--processes', type=int, metavar='N',
+                                      help='number of rendering processes (default: number of CPUs)')
 
     get_recommended_pricing = subparsers.add_parser(
         'recommendPricing', formatter_class=Formatter, help='show recommended pricing and allocation oprions')
     get_recommended_pricing.add_argument('profile', help='name of instance profile')
 
-    subparsers.add_parser('requestInstances', formatter_class=Formatter,
-                          help='create spot instance requests')
-
-    subparsers.add_parser('smartSpotRequest', formatter_class=Formatter,
-                          help="automated 'single shot' spot instance request")
-
-    subparsers.add_parser('listRequests', formatter_class=Formatter, help='show instance requests')
-
-    subparsers.add_parser('listInstances', formatter_class=Formatter, help='show active instances')
-
-    reboot_instances_parser = subparsers.add_parser(
-        'rebootInstances', formatter_class=Formatter, help='reboot specified instance(s)')
-    reboot_instances_parser.add_argument('id', nargs='+', help='instance ID(s)')
+    watch_pricing = subparsers.add_parser(
+        'watchPricing', formatter_class=Formatter, help='keep recommended pricing current, printing bid changes live')
+    watch_pricing.add_argument('profile', help='name of instance profile')
+    watch_pricing.add_argument('--days', default=7, type=int,
+                               help='sliding window in days of price statistics (default: %(default)s)')
+    watch_pricing.add_argument('--interval', default=300, type=float, metavar='SECONDS',
+                               help='time between polls of new price records (default: %(default)s)')
+    watch_pricing.add_argument('--halfLife', type=float, metavar='HOURS',
+                               help='age halving the weight of prices in the bid (default: the window)')
+
+    backtest_bid = subparsers.add_parser(
+        'backtestBid', formatter_class=Formatter, help='replay price history against candidate bids')
+    backtest_bid.add_argument('profile', help='name of instance profile')
+    backtest_bid.add_argument('--days', default=30, type=int,
+                              help='period in days to replay (default: %(default)s)')
+    backtest_bid.add_argument('--bids', nargs='+', type=float, metavar='PRICE',
+                              help='bids to evaluate (default: evenly spaced grid over observed prices)')
+    backtest_bid.add_argument('--steps', default=1000, type=int,
+                              help='number of bids in the default grid (default: %(default)s)')
+    backtest_bid.add_argument('--minRunFraction', default=0.99, type=float, metavar='FRACTION',
+                              help='required fraction of time running (default: %(default)s)')
+
+    recommend_batch = subparsers.add_parser(
+        'recommendBatch', formatter_class=Formatter, help='rank pricing options of many profiles and regions')
+    recommend_batch.add_argument('--profiles', nargs='+', metavar='PROFILE',
+                                 help='names of instance profiles (default: all)')
+    recommend_batch.add_argument('--regions', nargs='+', metavar='REGION',
+                                 help='regions to query (default: current region)')
+    recommend_batch.add_argument('--days', default=7, type=int,
+                                 help='period in days to analyze (default: %(default)s)')
+
+    request_instances = subparsers.add_parser('requestInstances', formatter_class=Formatter,
+                                              help='create spot instance requests')
+    request_instances.add_argument('--timeout', type=int, metavar='SECONDS',
+                                   help='stop waiting for fulfilment after (default: wait until evaluated)')
+
+    smart_spot_request = subparsers.add_parser('smartSpotRequest', formatter_class=Formatter,
+                                               help="automated 'single shot' spot instance request")
+    smart_spot_request.add_argument('--timeout', type=int, metavar='SECONDS',
+                                    help='stop waiting for fulfilment after (default: wait until evaluated)')
+
+    subparsers.add_parser('listRequests', formatter_class=Formatter, parents=[listing_parser],
+                          help='show instance requests')
+
+    subparsers.add_parser('listInstances', formatter_class=Formatter, parents=[listing_parser],
+                          help='show active instances')
+
+    # Common options of bulk lifecycle commands selecting user's resources
+    selection_parser = argparse.ArgumentParser(add_help=False)
+    selection_parser.add_argument('id', nargs='*', help='resource ID(s)')
+    selection_parser.add_argument('--state', nargs='+', metavar='STATE', help='select resources in state(s)')
+    selection_parser.add_argument('--olderThan', type=float, metavar='HOURS',
+                                  help='select resources created more than HOURS ago')
+    selection_parser.add_argument('--tag', nargs='+', default=[], metavar='KEY=VALUE',
+                                  help='select resources having tag(s)')
+    selection_parser.add_argument('--yes', action='store_true', help='do not ask for confirmation')
+
+    subparsers.add_parser('rebootInstances', formatter_class=Formatter, parents=[selection_parser],
+                          help='reboot specified instance(s)')
 
     terminate_instances_parser = subparsers.add_parser(
-        'terminateInstances', formatter_class=Formatter, help='terminate specified instance(s), spot requests will be closed resp')
-    terminate_instances_parser.add_argument('id', nargs='+', help='instance ID(s)')
+        'terminateInstances', formatter_class=Formatter, parents=[selection_parser],
+        help='terminate specified instance(s), spot requests will be closed resp')
+    terminate_instances_parser.add_argument('--wait', action='store_true', help='wait for termination')
+
+    delete_volumes = subparsers.add_parser('deleteVolumes', formatter_class=Formatter, parents=[selection_parser],
+                                           help='permanently delete specified volume(s)')
+    delete_volumes.add_argument('--detach', action='store_true', help='detach volumes in use first')
+    delete_volumes.add_argument('--force', action='store_true', help='force detachment')
+    delete_volumes.add_argument('--wait', action='store_true', help='wait for deletion')
+
+    detach_volumes = subparsers.add_parser('detachVolumes', formatter_class=Formatter, parents=[selection_parser],
+                                           help='detach specified volume(s) from instances')
+    detach_volumes.add_argument('--force', action='store_true', help='force detachment')
+    detach_volumes.add_argument('--wait', action='store_true', help='wait for volumes to become available')
+
+    provision = subparsers.add_parser('provision', formatter_class=Formatter,
+                                      help='request spot instances of many profiles listed in a manifest')
+    provision.add_argument('manifest', help='path to the JSON manifest file')
+    provision.add_argument('--days', default=7, type=int,
+                           help='period in days of price history to recommend from (default: %(default)s)')
+    provision.add_argument('--timeout', type=int, metavar='SECONDS',
+                           help='stop waiting for fulfilment after (default: wait until evaluated)')
+    provision.add_argument('--dryRun', action='store_true', help='only show the requests to submit')
+    provision.add_argument('--yes', action='store_true', help='do not ask for confirmation')
 
     return parser
 
@@ -101,92 +225,279 @@ def read_config(file_path):
     return config
 
 
-def print_price_history(price_history, recommend=True):
+# Environment variables choosing the AWS account, credentials and region of boto3 clients
+AWS_ENVIRONMENT = ('AWS_PROFILE', 'AWS_DEFAULT_PROFILE', 'AWS_REGION', 'AWS_DEFAULT_REGION', 'AWS_ACCESS_KEY_ID',
+                   'AWS_CONFIG_FILE', 'AWS_SHARED_CREDENTIALS_FILE')
+
+
+def get_config_digest(user_profile, instance_profiles):
+    """Fingerprint of what answers depend on: user's tags, instance profiles and the AWS environment.
+
+    The AWS profile, region and credentials are compared through the environment variables
+    selecting them, so callers do not have to load boto3 to resolve them.
+    """
+    import hashlib
+    environment = {name: os.environ.get(name) for name in AWS_ENVIRONMENT}
+    data = json.dumps({'user_profile': user_profile, 'instance_profiles': instance_profiles,
+                       'environment': environment}, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def parse_tags(tags):
+    """Convert a list of 'KEY=VALUE' strings into a dict."""
+    return dict(tag.split('=', 1) for tag in tags)
+
+
+def has_selectors(options):
+    return bool(options.state or options.olderThan is not None or options.tag)
+
+
+def select_resources(select, options, default_states=None):
+    """Resolve resource ids given on command line with bulk selection options.
+
+    Plain id lists are used as is. With any selector, user's resources matching all of
+    them are looked up with 'select' and the selection has to be confirmed unless '--yes'.
+    """
+    if not has_selectors(options):
+        return options.id
+    ids = select(options.id, options.state or default_states, options.olderThan, parse_tags(options.tag))
+    print('Selected {} resource(s): {}'.format(len(ids), ', '.join(ids)))
+    if len(ids) > 0 and not options.yes and input('Proceed (y/n): ') != 'y':
+        return []
+    return ids
+
+
+@metrics.timed('get_zones_stats')
+def get_zones_stats(price_history, resolution=None):
+    import stats
+    return stats.get_zones_stats(price_history, resolution)
+
+
+@metrics.timed('print_price_history')
+def print_price_history(price_history, recommend=True, resolution=None):
+    import stats
+    zones_stats = get_zones_stats(price_history, resolution)
     fields = ['Zone', 'Current', 'Min', 'Max', 'Mean', 'Std']
     print('{:13}{:9}{:8}{:8}{:8}{:8}'.format(*fields))
-    for zone in sorted(price_history.keys()):
-        price_arr = mlab.rec_groupby(
-            price_history[zone], ('timestamp',), (('price', np.max, 'max_price'),))['max_price']
-        row = [zone, price_arr[-1], np.min(price_arr), np.max(price_arr),
-               np.mean(price_arr), np.std(price_arr)]
+    for zone_stats in sorted(zones_stats, key=lambda zone_stats: zone_stats.zone):
+        row = [zone_stats.zone, zone_stats.current, zone_stats.min, zone_stats.max,
+               zone_stats.mean, zone_stats.std]
         print('{:13}${:<8.2f}${:<7.2f}${:<7.2f}${:<7.2f}${:<7.2f}'.format(*row))
     if recommend:
-        rec_zone, rec_price = get_recommended_pricing(price_history)
+        rec_zone, rec_price = stats.recommend(zones_stats)
         print('RECOMMENDED BIDDING (ZONE: {}, PRICE: {:.2f})'.format(rec_zone, rec_price))
 
 
-def plot_price_history(price_history, plot_hist=False):
-    num_zones = len(price_history.keys())
+def draw_price_history(zones_stats, new_figure, plot_hist=False, max_points=1000, downsample='lttb'):
+    """Draw price history curves (and histograms) of 'zones_stats' on figures made by 'new_figure'.
 
-    plt.ion()
-    fig_price = plt.figure(figsize=(15, 8))
+    Every curve is downsampled to at most 'max_points' points with a 'stats.DOWNSAMPLING'
+    method, so drawing time does not depend on the length of the history.
+    """
+    import numpy as np
+    import matplotlib
+    from matplotlib.dates import AutoDateLocator, DateFormatter
+    import stats
+
+    num_zones = len(zones_stats)
+    fig_price = new_figure(figsize=(15, 8))
     ax_price = fig_price.add_subplot(111)
-    ax_price.xaxis.set_major_locator(DayLocator())
-    ax_price.xaxis.set_minor_locator(HourLocator())
+    ax_price.xaxis.set_major_locator(AutoDateLocator())
     ax_price.xaxis.set_major_formatter(DateFormatter('%b %d'))
-    ax_price.autoscale_view()
     ax_price.grid(True)
 
+    fig_hist = None
     if plot_hist:
         num_rows = int(num_zones / 2) + (num_zones % 2)
-        fig_hist = plt.figure(figsize=(15, 8))
-        fig_hist.set_tight_layout(True)
+        fig_hist = new_figure(figsize=(15, 8))
+        fig_hist.set_layout_engine('tight')
 
-    colors = plt.cm.Spectral(np.linspace(0, 1, num_zones))
-    min_date, max_date = datetime.today(), datetime(1970, 1, 1)
-    for zone, color, i in zip(sorted(price_history.keys()), colors, range(1, num_zones + 1)):
+    colors = matplotlib.colormaps['Spectral'](np.linspace(0, 1, num_zones))
+    zones_stats_sorted = sorted(zones_stats, key=lambda zone_stats: zone_stats.zone)
+    for zone_stats, color, i in zip(zones_stats_sorted, colors, range(1, num_zones + 1)):
         # Plot price history curves
-        grouped = mlab.rec_groupby(
-            price_history[zone], ('timestamp',), (('price', np.max, 'max_price'),))
-        price_arr, date_arr = grouped['max_price'], [
-            x.astype(datetime) for x in grouped['timestamp']]
-        price_stats = [zone, price_arr[-1],
-                       np.min(price_arr), np.max(price_arr), np.mean(price_arr), np.std(price_arr)]
+        date_arr, price_arr = stats.DOWNSAMPLING[downsample](zone_stats.timestamp, zone_stats.price, max_points)
+        price_stats = [zone_stats.zone, zone_stats.current,
+                       zone_stats.min, zone_stats.max, zone_stats.mean, zone_stats.std]
         label = '{:14}current: ${:<6.2f}min: ${:<6.2f}max: ${:<6.2f}mean: ${:<6.2f}std: ${:<6.2f}'.format(
             *price_stats)
-        ax_price.plot_date(date_arr, price_arr, '-', color=color, linewidth=1.5, label=label)
-        # Plot price history histogram
+        ax_price.plot(date_arr, price_arr, '-', color=color, linewidth=1.5, label=label)
+        # Plot price history histogram, binned over all the prices
         if plot_hist:
             ax_hist = fig_hist.add_subplot(num_rows, 2, i)
-            ax_hist.hist(price_arr, 200, range=(0, np.max(price_arr) + 0.5), color=color, alpha=0.7)
-            ax_hist.set_title('{} (examples: {})'.format(zone, price_arr.size))
+            counts, edges = np.histogram(zone_stats.price, 200, range=(0, zone_stats.max + 0.5))
+            ax_hist.stairs(counts, edges, fill=True, color=color, alpha=0.7)
+            ax_hist.set_title('{} (examples: {})'.format(zone_stats.zone, zone_stats.price.size))
             ax_hist.set_xlabel("Price")
             ax_hist.set_ylabel("Frequency")
-        # Calculating time boundaries
-        min_date, max_date = min(min_date, np.min(date_arr)), max(max_date, np.max(date_arr))
 
-    rec_zone, rec_price = get_recommended_pricing(price_history)
+    rec_zone, rec_price = stats.recommend(zones_stats)
     label = 'RECOMMENDED BIDDING (ZONE: {}, PRICE: {:.2f})'.format(rec_zone, rec_price)
-    ax_price.plot_date([min_date, max_date], [rec_price, rec_price], 'r-', linewidth=2, label=label)
-
-    ax_price.legend(loc='upper center', fancybox=True, shadow=True, ncol=1).draggable()
-
-    return fig_price, ax_price, fig_hist if plot_hist else None
-
+    min_date = min(zone_stats.timestamp[0] for zone_stats in zones_stats)
+    max_date = max(zone_stats.timestamp[-1] for zone_stats in zones_stats)
+    ax_price.plot([min_date, max_date], [rec_price, rec_price], 'r-', linewidth=2, label=label)
+    ax_price.legend(loc='upper center', fancybox=True, shadow=True, ncol=1)
 
-def get_recommended_pricing(price_history):
-    # Get recommended availability zone
-    zones_stats = []
-    for zone in price_history:
-        price_arr = mlab.rec_groupby(
-            price_history[zone], ('timestamp',), (('price', np.max, 'max_price'),))['max_price']
-        three_sigma = np.mean(price_arr) + (3 * np.std(price_arr))
-        percentile = np.percentile(price_arr, 99)
-        zones_stats.append((zone, max(three_sigma, percentile)))
-    zone, stat = sorted(zones_stats, key=lambda x: x[1])[0]
+    return fig_price, ax_price, fig_hist
 
-    price_arr = mlab.rec_groupby(
-        price_history[zone], ('timestamp',), (('price', np.max, 'max_price'),))['max_price']
 
-    n = len(price_arr)
-    base = np.arange(n, dtype=np.float) / n
-    weights = np.tanh((base - 0.7) / 0.2)
-    weights = (weights - np.min(weights)) / (np.max(weights) - np.min(weights)) + 1
-    weights /= np.sum(weights)
+@metrics.timed('plot_price_history')
+def plot_price_history(price_history, plot_hist=False, resolution=None, max_points=1000, downsample='lttb'):
+    """Show price history plots in interactive windows."""
+    # matplotlib is slow to import, load it only when plotting
+    import matplotlib.pyplot as plt
 
-    weighted = np.multiply(weights, price_arr)
-
-    price = np.max(
-        price_arr[np.where(weighted >= np.percentile(weighted, 99, interpolation='nearest'))])
-
-    return (zone, price)
+    plt.ion()
+    fig_price, ax_price, fig_hist = draw_price_history(get_zones_stats(price_history, resolution), plt.figure,
+                                                       plot_hist, max_points, downsample)
+    ax_price.get_legend().set_draggable(True)
+    return fig_price, ax_price, fig_hist
+
+
+def get_histogram_path(path):
+    root, ext = os.path.splitext(path)
+    return root + '_hist' + ext
+
+
+@metrics.timed('save_price_history_plot')
+def save_price_history_plot(price_history, path, plot_hist=False, resolution=None, max_points=1000,
+                            downsample='lttb'):
+    """Render price history plot to an image file without a display.
+
+    The format (e.g. png, svg) follows the extension of 'path', histograms are saved next
+    to it with a '_hist' suffix. Return the list of written files.
+    """
+    # Figures not managed by pyplot are drawn by non-interactive backends only
+    from matplotlib.figure import Figure
+
+    fig_price, ax_price, fig_hist = draw_price_history(get_zones_stats(price_history, resolution), Figure,
+                                                       plot_hist, max_points, downsample)
+    fig_price.savefig(path)
+    if fig_hist is None:
+        return [path]
+    fig_hist.savefig(get_histogram_path(path))
+    return [path, get_histogram_path(path)]
+
+
+def save_price_history_plots(jobs, max_workers=None, **kwargs):
+    """Render (path, price history) 'jobs' to image files in parallel worker processes.
+
+    'kwargs' are passed to 'save_price_history_plot'. Return the list of written files.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(save_price_history_plot, price_history, path, **kwargs)
+                   for path, price_history in jobs]
+        return [path for future in futures for path in future.result()]
+
+
+@metrics.timed('print_backtest')
+def print_backtest(result, min_run_fraction=0.99, show_all=False):
+    """Print backtest outcomes of every (zone, bid) pair or the cheapest bid of each zone."""
+    import backtest
+    if len(result.zones) == 0:
+        print('No price history to backtest')
+        return
+    fields = ['Zone', 'Bid', 'Running', 'Interrupts', 'MeanRun(h)', 'Cost']
+    print('{:13}{:9}{:9}{:12}{:12}{:9}'.format(*fields))
+    if show_all:
+        rows = [(zone, j) for zone in result.zones for j in range(result.bids.size)]
+    else:
+        rows = backtest.get_cheapest_bids(result, min_run_fraction)
+    zone_index = {zone: i for i, zone in enumerate(result.zones)}
+    for zone, j in rows:
+        i = zone_index[zone]
+        row = [zone, result.bids[j], '{:.2f}%'.format(result.run_fraction[i, j] * 100), result.interruptions[i, j],
+               result.mean_run_hours[i, j], result.cost[i, j]]
+        print('{:13}${:<8.3f}{:9}{:<12}{:<12.1f}${:<8.2f}'.format(*row))
+    if not show_all:
+        if len(rows) > 0:
+            print('RECOMMENDED BIDDING (ZONE: {}, PRICE: {:.3f})'.format(rows[0][0], result.bids[rows[0][1]]))
+        else:
+            print('No bid runs {:.2f}% of the time'.format(min_run_fraction * 100))
+
+
+@metrics.timed('get_batch_recommendations')
+def get_batch_recommendations(batch_history, resolution=None):
+    """Rank zones of every (region, profile) in 'batch_history' by risk.
+
+    Return a list of (region, profile, ZoneStats) sorted by profile, then by risk.
+    """
+    profiles = list(OrderedDict.fromkeys(profile for region, profile in batch_history))
+    rows = [(region, profile, zone_stats)
+            for (region, profile), price_history in batch_history.items()
+            for zone_stats in get_zones_stats(price_history, resolution)]
+    return sorted(rows, key=lambda row: (profiles.index(row[1]), row[2].risk))
+
+
+def print_batch_recommendations(rows):
+    fields = ['Profile', 'Rank', 'Region', 'Zone', 'Bid', 'Current', 'Mean', 'Std', 'P99', '3Sigma']
+    print('{:14}{:6}{:16}{:17}{:9}{:9}{:8}{:8}{:8}{:8}'.format(*fields))
+    rank = {}
+    for region, profile, zone_stats in rows:
+        rank[profile] = rank.get(profile, 0) + 1
+        row = [profile, rank[profile], region, zone_stats.zone, zone_stats.weighted_bid, zone_stats.current,
+               zone_stats.mean, zone_stats.std, zone_stats.p99, zone_stats.three_sigma]
+        print('{:14}{:<6}{:16}{:17}${:<8.2f}${:<8.2f}${:<7.2f}${:<7.2f}${:<7.2f}${:<7.2f}'.format(*row))
+
+
+@metrics.timed('get_recommended_pricing')
+def get_recommended_pricing(price_history, resolution=None):
+    import stats
+    return stats.recommend(get_zones_stats(price_history, resolution))
+
+
+def watch_recommendations(recommender, interval):
+    """Poll 'streaming.StreamingRecommender' every 'interval' seconds printing bid changes until interrupted."""
+    import time
+    import stats
+    bids, recommendation = {}, None
+    print('{:10}{:13}{:9}{:9}{:9}{:8}{:8}'.format('Time', 'Zone', 'Bid', 'Was', 'Current', 'Mean', 'P99'))
+    try:
+        while True:
+            start = time.monotonic()
+            zones_stats = recommender.poll()
+            now = time.strftime('%H:%M:%S')
+            for zone_stats in zones_stats:
+                bid = round(float(zone_stats.weighted_bid), 3)
+                if bids.get(zone_stats.zone) != bid:
+                    was = '${:.3f}'.format(bids[zone_stats.zone]) if zone_stats.zone in bids else '-'
+                    row = [now, zone_stats.zone, bid, was, zone_stats.current, zone_stats.mean, zone_stats.p99]
+                    print('{:10}{:13}${:<8.3f}{:9}${:<8.3f}${:<7.3f}${:<7.3f}'.format(*row))
+                    bids[zone_stats.zone] = bid
+            if len(zones_stats) > 0 and stats.recommend(zones_stats) != recommendation:
+                recommendation = stats.recommend(zones_stats)
+                print('{:10}RECOMMENDED BIDDING (ZONE: {}, PRICE: {:.2f})'.format(now, *recommendation), flush=True)
+            time.sleep(max(0, interval - (time.monotonic() - start)))
+    except KeyboardInterrupt:
+        pass
+
+
+def print_allocations(allocations):
+    fields = ['Line', 'Profile', 'Zone', 'Price', 'Count', 'ValidHours']
+    print('{:6}{:14}{:17}{:9}{:7}{}'.format(*fields))
+    for allocation in allocations:
+        row = [allocation.line, allocation.profile, allocation.zone, allocation.price, allocation.count,
+               allocation.valid_hours or '']
+        print('{:<6}{:14}{:17}${:<8.3f}{:<7}{}'.format(*row))
+    print('Total: {} instance(s) in {} request(s)'.format(sum(allocation.count for allocation in allocations),
+                                                          len(allocations)))
+
+
+def print_provision_report(results):
+    """Print outcome of every allocation of 'Client.request_spot_allocations' results."""
+    fields = ['Line', 'Profile', 'Zone', 'Price', 'Count', 'Active', 'Open', 'Failed', 'Instances']
+    print('{:6}{:14}{:17}{:9}{:7}{:8}{:6}{:8}{}'.format(*fields))
+    totals = [0, 0, 0, 0]
+    for allocation, requests in results.items():
+        if isinstance(requests, Exception):
+            counts, instances = [allocation.count, 0, 0, allocation.count], 'FAILED ({})'.format(requests)
+        else:
+            states = [request['State'] for request in requests]
+            active = states.count('active')
+            counts = [allocation.count, active, states.count('open'), len(states) - active - states.count('open')]
+            instances = ','.join(request['InstanceId'] for request in requests if request['State'] == 'active')
+        totals = [total + count for total, count in zip(totals, counts)]
+        row = [allocation.line, allocation.profile, allocation.zone, allocation.price, *counts, instances]
+        print('{:<6}{:14}{:17}${:<8.3f}{:<7}{:<8}{:<6}{:<8}{}'.format(*row))
+    print('Total: {} requested, {} active, {} open, {} failed'.format(*totals))